@@ -0,0 +1,102 @@
+# Admission control for the analysis and chat paths.
+#
+# Each expensive path (the model cascade, Gemma generation) is guarded by an
+# AdmissionController: at most max_concurrent requests run, up to max_queue
+# more wait, and a waiter that doesn't get a slot within queue_timeout
+# seconds is turned away. Rejected requests raise Overloaded immediately
+# instead of piling onto a saturated node, so admitted requests keep their
+# latency and everyone else gets a fast "busy, retry" answer.
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import tracing
+
+ANALYSIS_MAX_CONCURRENT = int(os.environ.get("ANALYSIS_MAX_CONCURRENT", "2"))
+ANALYSIS_MAX_QUEUE = int(os.environ.get("ANALYSIS_MAX_QUEUE", "8"))
+ANALYSIS_QUEUE_TIMEOUT = float(os.environ.get("ANALYSIS_QUEUE_TIMEOUT", "15"))
+# the worker batches up to GENERATION_MAX_BATCH prompts, so admit about that many
+LLM_MAX_CONCURRENT = int(os.environ.get("LLM_MAX_CONCURRENT", "8"))
+LLM_MAX_QUEUE = int(os.environ.get("LLM_MAX_QUEUE", "8"))
+LLM_QUEUE_TIMEOUT = float(os.environ.get("LLM_QUEUE_TIMEOUT", "5"))
+
+
+class Overloaded(Exception):
+    def __init__(self, name, reason, retry_after):
+        super().__init__(f"{name} is busy ({reason}); retry in about {retry_after:.0f}s")
+        self.name = name
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    def __init__(self, name, max_concurrent, max_queue, queue_timeout):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiting = 0
+        self._stats = {"admitted": 0, "rejected": 0, "timed_out": 0}
+        self._queue_waits = deque(maxlen=1000)
+
+    def _acquire(self):
+        start = time.monotonic()
+        with self._cond:
+            if self._active >= self.max_concurrent:
+                if self._waiting >= self.max_queue:
+                    self._stats["rejected"] += 1
+                    raise Overloaded(self.name, "queue full", self.queue_timeout)
+                self._waiting += 1
+                try:
+                    deadline = start + self.queue_timeout
+                    while self._active >= self.max_concurrent:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self._stats["timed_out"] += 1
+                            raise Overloaded(self.name, "queue deadline exceeded", self.queue_timeout)
+                        self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+            self._active += 1
+            self._stats["admitted"] += 1
+            self._queue_waits.append(time.monotonic() - start)
+
+    def _release(self):
+        with self._cond:
+            self._active -= 1
+            self._cond.notify()
+
+    # Context manager around one request; raises Overloaded if not admitted
+    @contextmanager
+    def admit(self):
+        start = time.monotonic()
+        try:
+            self._acquire()
+        except Overloaded as e:
+            tracing.add_span(f"admission.{self.name}", time.monotonic() - start, shed=e.reason)
+            raise
+        tracing.add_span(f"admission.{self.name}", time.monotonic() - start)
+        try:
+            yield
+        finally:
+            self._release()
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats, active=self._active, waiting=self._waiting)
+            waits = sorted(self._queue_waits)
+        stats["shed"] = stats["rejected"] + stats["timed_out"]
+        stats["queue_wait_p95"] = waits[min(len(waits) - 1, len(waits) * 95 // 100)] if waits else 0.0
+        return stats
+
+
+def analysis_admission():
+    return AdmissionController("analysis", ANALYSIS_MAX_CONCURRENT, ANALYSIS_MAX_QUEUE, ANALYSIS_QUEUE_TIMEOUT)
+
+
+def llm_admission():
+    return AdmissionController("assistant", LLM_MAX_CONCURRENT, LLM_MAX_QUEUE, LLM_QUEUE_TIMEOUT)
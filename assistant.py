@@ -0,0 +1,861 @@
+# Chat templates and routing for the medical assistant.
+#
+# Keyword questions ("food", "recovery", ...) are answered from the canned
+# sections below; anything else is turned into a prompt for the Gemma
+# worker (see assistant_worker.py). Nothing here imports the LLM stack.
+
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import nullcontext
+
+import tracing
+
+# Response cache for free-text answers
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", "1024"))
+# seconds before a cached answer is regenerated
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", "86400"))
+
+# Earlier turns passed to the LLM: the newest messages, each truncated
+CHAT_CONTEXT_MESSAGES = int(os.environ.get("CHAT_CONTEXT_MESSAGES", "6"))
+CHAT_CONTEXT_CHARS = int(os.environ.get("CHAT_CONTEXT_CHARS", "300"))
+
+# Words that don't change what is being asked
+_STOPWORDS = {
+    "a", "an", "the", "i", "my", "me", "is", "are", "am", "be", "it", "its", "to", "of", "for",
+    "do", "does", "can", "could", "should", "would", "will", "please", "you", "your", "and", "or",
+    "in", "on", "with", "this", "that", "what", "whats", "so", "just", "really", "much", "very",
+}
+
+# Keywords for each section
+SECTION_KEYWORDS = {
+    "all": ["all", "everything", "complete", "comprehensive", "full", "total", "guide", "overview", "summary"],
+    "suggestions": ["suggestions", "suggestion", "tips", "advice", "recommendations", "what to do", "how to"],
+    "precautions": ["precautions", "precaution", "safety", "avoid", "don't", "restrictions", "careful"],
+    "food": ["food", "diet", "nutrition", "eating", "dietary", "meals", "supplements", "vitamins"],
+    "medicine": ["medicine", "medication", "drugs", "pills", "pain", "relief", "treatment", "medicines"],
+    "exercise": ["exercise", "workout", "training", "physical", "activity", "movement", "fitness", "sports"],
+    "emergency": ["emergency", "urgent", "danger", "warning", "severe", "critical", "immediate", "help"],
+    "recovery": ["recovery", "healing", "timeline", "progress", "rehab", "rehabilitation", "heal", "improve"]
+}
+
+ANALYSIS_MESSAGE_PREFIX = "I've analyzed"
+
+NO_IMAGE_RESPONSE = """Please upload an X-ray image and click 'Analyze Image' first so I can help you.
+
+💡 **What I can help you with once you upload an X-ray:**
+• **"all"** - Complete comprehensive guide
+• **"suggestions"** - Treatment and recovery tips
+• **"precautions"** - Safety measures
+• **"food"** - Dietary recommendations
+• **"medicine"** - Medication guidelines
+• **"exercise"** - Physical activity recommendations
+• **"emergency"** - Emergency signs and when to seek help
+• **"recovery"** - Recovery timeline and progress"""
+
+
+# First section whose keywords appear in the prompt, or None
+def detect_section(prompt):
+    prompt_lower = prompt.lower()
+    for section, keywords in SECTION_KEYWORDS.items():
+        if any(keyword in prompt_lower for keyword in keywords):
+            return section
+    return None
+
+
+# Section-specific responses for a bone type, keyed by section then prediction
+def section_responses(bone_type):
+    return {
+        "all": {
+            "fractured": f"""
+**📋 COMPREHENSIVE GUIDE FOR FRACTURED {bone_type.upper()}**
+
+---
+
+**💡 SUGGESTIONS & TREATMENT PLAN:**
+
+• **Immediate Actions:**
+  - Immobilize the affected area immediately
+  - Apply ice pack for 15-20 minutes every 2-3 hours
+  - Elevate the limb to reduce swelling
+  - Seek emergency medical care
+
+• **Medical Consultation:**
+  - Visit orthopedic specialist within 24 hours
+  - Get proper X-ray and imaging done
+  - Follow doctor's treatment plan strictly
+
+• **Recovery Tips:**
+  - Keep the cast/splint dry and clean
+  - Follow physical therapy recommendations
+  - Avoid putting weight on the injured area
+  - Attend all follow-up appointments
+
+---
+
+**⚠️ PRECAUTIONS & SAFETY MEASURES:**
+
+• **Movement Restrictions:**
+  - DO NOT move or put weight on the injured area
+  - Avoid any twisting or bending motions
+  - Keep the limb elevated when possible
+  - Use crutches or sling as prescribed
+
+• **Cast/Splint Care:**
+  - Keep the cast completely dry
+  - Don't insert objects inside the cast
+  - Report any pain, swelling, or numbness
+  - Don't cut or modify the cast yourself
+
+• **Activity Limitations:**
+  - Avoid driving until cleared by doctor
+  - Don't participate in sports or heavy lifting
+  - Follow specific activity restrictions
+  - Attend all physical therapy sessions
+
+---
+
+**🍎 DIETARY RECOMMENDATIONS:**
+
+• **Essential Nutrients:**
+  - **Calcium**: Dairy products, leafy greens, fortified foods
+  - **Vitamin D**: Fatty fish, egg yolks, sunlight exposure
+  - **Protein**: Lean meats, fish, eggs, legumes
+  - **Vitamin C**: Citrus fruits, berries, bell peppers
+
+• **Foods to Include:**
+  - Milk, yogurt, and cheese for calcium
+  - Salmon, tuna for vitamin D and omega-3
+  - Nuts and seeds for minerals
+  - Dark leafy vegetables for vitamins
+
+• **Foods to Avoid:**
+  - Excessive caffeine (can interfere with calcium absorption)
+  - High-sodium foods (can cause swelling)
+  - Alcohol (slows healing process)
+  - Processed foods with low nutritional value
+
+• **Hydration:**
+  - Drink 8-10 glasses of water daily
+  - Include bone broth for collagen
+  - Avoid sugary drinks
+
+---
+
+**💊 MEDICATION GUIDELINES:**
+
+• **Pain Management:**
+  - **Over-the-counter**: Acetaminophen (Tylenol) for pain
+  - **Anti-inflammatory**: Ibuprofen (Advil) for swelling
+  - **Prescription**: Follow doctor's recommendations for stronger pain relievers
+  - **Topical**: Ice packs and elevation for natural relief
+
+• **Important Notes:**
+  - Take medications exactly as prescribed
+  - Don't exceed recommended dosages
+  - Inform doctor of all medications you're taking
+  - Report any side effects immediately
+
+• **Medications to Avoid:**
+  - Don't take aspirin without doctor's approval
+  - Avoid blood thinners unless prescribed
+  - Be cautious with herbal supplements
+  - Don't mix medications without consultation
+
+• **Follow-up Care:**
+  - Attend all medical appointments
+  - Keep track of medication schedule
+  - Report any unusual symptoms
+  - Follow rehabilitation protocols
+
+---
+
+**🏥 EMERGENCY SIGNS TO WATCH FOR:**
+- Severe pain that doesn't improve with medication
+- Numbness or tingling in fingers/toes
+- Blue or cold extremities
+- Fever or signs of infection
+- Difficulty breathing or chest pain
+
+**📞 WHEN TO CALL EMERGENCY:**
+- If you experience any emergency signs
+- If the cast becomes too tight or uncomfortable
+- If you notice any unusual symptoms
+- If pain becomes unbearable
+            """,
+            "normal": f"""
+**📋 COMPREHENSIVE GUIDE FOR NORMAL {bone_type.upper()}**
+
+---
+
+**💡 SUGGESTIONS & SELF-CARE:**
+
+• **Self-Care Measures:**
+  - Rest the affected area for 24-48 hours
+  - Apply ice if there's any swelling
+  - Gentle stretching exercises after 48 hours
+  - Monitor for any changes in symptoms
+
+• **Prevention Tips:**
+  - Maintain good posture and ergonomics
+  - Strengthen surrounding muscles
+  - Use proper techniques during activities
+  - Consider protective gear for sports
+
+• **When to Seek Help:**
+  - If pain persists beyond 48 hours
+  - If swelling or bruising increases
+  - If you experience numbness or tingling
+  - If movement becomes more difficult
+
+---
+
+**⚠️ PRECAUTIONS & PREVENTION:**
+
+• **Activity Modifications:**
+  - Avoid repetitive strain movements
+  - Take regular breaks during activities
+  - Use proper ergonomics at work
+  - Warm up before physical activities
+
+• **Lifestyle Adjustments:**
+  - Maintain good posture throughout the day
+  - Avoid sudden jerky movements
+  - Use supportive equipment when needed
+  - Listen to your body's signals
+
+• **Prevention Measures:**
+  - Regular exercise to strengthen muscles
+  - Proper nutrition for bone health
+  - Adequate rest and recovery time
+  - Regular check-ups with healthcare provider
+
+---
+
+**🍎 DIETARY RECOMMENDATIONS:**
+
+• **Bone-Strengthening Foods:**
+  - **Calcium-rich**: Dairy, fortified plant milk, leafy greens
+  - **Vitamin D**: Fatty fish, mushrooms, fortified foods
+  - **Magnesium**: Nuts, seeds, whole grains
+  - **Vitamin K**: Green vegetables, fermented foods
+
+• **Anti-Inflammatory Foods:**
+  - Fatty fish (salmon, mackerel)
+  - Berries and cherries
+  - Turmeric and ginger
+  - Olive oil and avocados
+
+• **Foods to Limit:**
+  - Processed foods high in salt
+  - Sugary snacks and beverages
+  - Excessive alcohol consumption
+  - Foods high in saturated fats
+
+• **Hydration:**
+  - Maintain adequate water intake
+  - Include herbal teas for antioxidants
+  - Avoid excessive caffeine
+
+---
+
+**💊 MEDICATION & SUPPLEMENTS:**
+
+• **Pain Relief (if needed):**
+  - **Mild pain**: Acetaminophen (Tylenol)
+  - **Inflammation**: Ibuprofen (Advil) or Naproxen
+  - **Topical**: Pain relief creams or gels
+  - **Natural**: Arnica, turmeric supplements
+
+• **Preventive Supplements:**
+  - **Calcium**: 1000-1200mg daily (consult doctor)
+  - **Vitamin D**: 600-800 IU daily
+  - **Omega-3**: Fish oil supplements
+  - **Glucosamine**: For joint health (consult doctor)
+
+• **Important Guidelines:**
+  - Consult healthcare provider before starting supplements
+  - Don't exceed recommended dosages
+  - Monitor for any adverse reactions
+  - Inform doctor of all medications and supplements
+
+• **When to Seek Medical Help:**
+  - If pain persists despite medication
+  - If you experience side effects
+  - If symptoms worsen
+  - For prescription medication needs
+
+---
+
+**🏃‍♂️ EXERCISE & ACTIVITY RECOMMENDATIONS:**
+- Gentle stretching exercises
+- Low-impact activities like walking or swimming
+- Strength training for surrounding muscles
+- Flexibility exercises
+- Proper warm-up and cool-down routines
+
+**📊 MONITORING & FOLLOW-UP:**
+- Regular self-assessment of symptoms
+- Keep a pain and activity diary
+- Schedule regular check-ups
+- Monitor for any changes in condition
+            """
+        },
+        "suggestions": {
+            "fractured": f"""
+**💡 Suggestions for Fractured {bone_type}:**
+
+• **Immediate Actions:**
+  - Immobilize the affected area immediately
+  - Apply ice pack for 15-20 minutes every 2-3 hours
+  - Elevate the limb to reduce swelling
+  - Seek emergency medical care
+
+• **Medical Consultation:**
+  - Visit orthopedic specialist within 24 hours
+  - Get proper X-ray and imaging done
+  - Follow doctor's treatment plan strictly
+
+• **Recovery Tips:**
+  - Keep the cast/splint dry and clean
+  - Follow physical therapy recommendations
+  - Avoid putting weight on the injured area
+  - Attend all follow-up appointments
+            """,
+            "normal": f"""
+**💡 Suggestions for Normal {bone_type}:**
+
+• **Self-Care Measures:**
+  - Rest the affected area for 24-48 hours
+  - Apply ice if there's any swelling
+  - Gentle stretching exercises after 48 hours
+  - Monitor for any changes in symptoms
+
+• **Prevention Tips:**
+  - Maintain good posture and ergonomics
+  - Strengthen surrounding muscles
+  - Use proper techniques during activities
+  - Consider protective gear for sports
+
+• **When to Seek Help:**
+  - If pain persists beyond 48 hours
+  - If swelling or bruising increases
+  - If you experience numbness or tingling
+  - If movement becomes more difficult
+            """
+        },
+        "precautions": {
+            "fractured": f"""
+**⚠️ Precautions for Fractured {bone_type}:**
+
+• **Movement Restrictions:**
+  - DO NOT move or put weight on the injured area
+  - Avoid any twisting or bending motions
+  - Keep the limb elevated when possible
+  - Use crutches or sling as prescribed
+
+• **Cast/Splint Care:**
+  - Keep the cast completely dry
+  - Don't insert objects inside the cast
+  - Report any pain, swelling, or numbness
+  - Don't cut or modify the cast yourself
+
+• **Activity Limitations:**
+  - Avoid driving until cleared by doctor
+  - Don't participate in sports or heavy lifting
+  - Follow specific activity restrictions
+  - Attend all physical therapy sessions
+            """,
+            "normal": f"""
+**⚠️ Precautions for {bone_type} Health:**
+
+• **Activity Modifications:**
+  - Avoid repetitive strain movements
+  - Take regular breaks during activities
+  - Use proper ergonomics at work
+  - Warm up before physical activities
+
+• **Lifestyle Adjustments:**
+  - Maintain good posture throughout the day
+  - Avoid sudden jerky movements
+  - Use supportive equipment when needed
+  - Listen to your body's signals
+
+• **Prevention Measures:**
+  - Regular exercise to strengthen muscles
+  - Proper nutrition for bone health
+  - Adequate rest and recovery time
+  - Regular check-ups with healthcare provider
+            """
+        },
+        "food": {
+            "fractured": f"""
+**🍎 Dietary Recommendations for Fracture Recovery:**
+
+• **Essential Nutrients:**
+  - **Calcium**: Dairy products, leafy greens, fortified foods
+  - **Vitamin D**: Fatty fish, egg yolks, sunlight exposure
+  - **Protein**: Lean meats, fish, eggs, legumes
+  - **Vitamin C**: Citrus fruits, berries, bell peppers
+
+• **Foods to Include:**
+  - Milk, yogurt, and cheese for calcium
+  - Salmon, tuna for vitamin D and omega-3
+  - Nuts and seeds for minerals
+  - Dark leafy vegetables for vitamins
+
+• **Foods to Avoid:**
+  - Excessive caffeine (can interfere with calcium absorption)
+  - High-sodium foods (can cause swelling)
+  - Alcohol (slows healing process)
+  - Processed foods with low nutritional value
+
+• **Hydration:**
+  - Drink 8-10 glasses of water daily
+  - Include bone broth for collagen
+  - Avoid sugary drinks
+            """,
+            "normal": f"""
+**🍎 Dietary Recommendations for {bone_type} Health:**
+
+• **Bone-Strengthening Foods:**
+  - **Calcium-rich**: Dairy, fortified plant milk, leafy greens
+  - **Vitamin D**: Fatty fish, mushrooms, fortified foods
+  - **Magnesium**: Nuts, seeds, whole grains
+  - **Vitamin K**: Green vegetables, fermented foods
+
+• **Anti-Inflammatory Foods:**
+  - Fatty fish (salmon, mackerel)
+  - Berries and cherries
+  - Turmeric and ginger
+  - Olive oil and avocados
+
+• **Foods to Limit:**
+  - Processed foods high in salt
+  - Sugary snacks and beverages
+  - Excessive alcohol consumption
+  - Foods high in saturated fats
+
+• **Hydration:**
+  - Maintain adequate water intake
+  - Include herbal teas for antioxidants
+  - Avoid excessive caffeine
+            """
+        },
+        "medicine": {
+            "fractured": f"""
+**💊 Medication Guidelines for Fracture Recovery:**
+
+• **Pain Management:**
+  - **Over-the-counter**: Acetaminophen (Tylenol) for pain
+  - **Anti-inflammatory**: Ibuprofen (Advil) for swelling
+  - **Prescription**: Follow doctor's recommendations for stronger pain relievers
+  - **Topical**: Ice packs and elevation for natural relief
+
+• **Important Notes:**
+  - Take medications exactly as prescribed
+  - Don't exceed recommended dosages
+  - Inform doctor of all medications you're taking
+  - Report any side effects immediately
+
+• **Medications to Avoid:**
+  - Don't take aspirin without doctor's approval
+  - Avoid blood thinners unless prescribed
+  - Be cautious with herbal supplements
+  - Don't mix medications without consultation
+
+• **Follow-up Care:**
+  - Attend all medical appointments
+  - Keep track of medication schedule
+  - Report any unusual symptoms
+  - Follow rehabilitation protocols
+            """,
+            "normal": f"""
+**💊 Medication Guidelines for {bone_type} Health:**
+
+• **Pain Relief (if needed):**
+  - **Mild pain**: Acetaminophen (Tylenol)
+  - **Inflammation**: Ibuprofen (Advil) or Naproxen
+  - **Topical**: Pain relief creams or gels
+  - **Natural**: Arnica, turmeric supplements
+
+• **Preventive Supplements:**
+  - **Calcium**: 1000-1200mg daily (consult doctor)
+  - **Vitamin D**: 600-800 IU daily
+  - **Omega-3**: Fish oil supplements
+  - **Glucosamine**: For joint health (consult doctor)
+
+• **Important Guidelines:**
+  - Consult healthcare provider before starting supplements
+  - Don't exceed recommended dosages
+  - Monitor for any adverse reactions
+  - Inform doctor of all medications and supplements
+
+• **When to Seek Medical Help:**
+  - If pain persists despite medication
+  - If you experience side effects
+  - If symptoms worsen
+  - For prescription medication needs
+            """
+        },
+        "exercise": {
+            "fractured": f"""
+**🏃‍♂️ Exercise Guidelines for Fracture Recovery:**
+
+• **During Cast/Splint Period:**
+  - **Gentle Range of Motion**: Move unaffected joints
+  - **Isometric Exercises**: Contract muscles without moving joints
+  - **Breathing Exercises**: Deep breathing for circulation
+  - **Core Strengthening**: Gentle abdominal exercises
+
+• **Post-Cast Recovery:**
+  - **Physical Therapy**: Follow prescribed exercise program
+  - **Gradual Progression**: Start with gentle movements
+  - **Strength Training**: Build muscle gradually
+  - **Flexibility**: Gentle stretching as approved
+
+• **Activities to Avoid:**
+  - High-impact sports until cleared
+  - Heavy lifting or weight training
+  - Activities that cause pain
+  - Contact sports
+
+• **Safe Activities:**
+  - Walking (if approved by doctor)
+  - Swimming (after cast removal)
+  - Stationary cycling
+  - Gentle yoga (modified poses)
+            """,
+            "normal": f"""
+**🏃‍♂️ Exercise Recommendations for {bone_type} Health:**
+
+• **Strengthening Exercises:**
+  - **Resistance Training**: Light weights or resistance bands
+  - **Bodyweight Exercises**: Push-ups, squats, planks
+  - **Functional Movements**: Daily activity simulations
+  - **Core Strengthening**: Planks, bridges, bird dogs
+
+• **Flexibility & Mobility:**
+  - **Stretching**: Gentle daily stretching routine
+  - **Yoga**: Modified poses for joint health
+  - **Tai Chi**: Slow, controlled movements
+  - **Pilates**: Core and flexibility focus
+
+• **Cardiovascular Health:**
+  - **Low-Impact Cardio**: Walking, swimming, cycling
+  - **Interval Training**: Moderate intensity intervals
+  - **Aerobic Activities**: Dancing, hiking
+  - **Recovery**: Proper rest between sessions
+
+• **Prevention Focus:**
+  - **Balance Training**: Single-leg exercises
+  - **Proprioception**: Balance board exercises
+  - **Posture Work**: Ergonomic awareness
+  - **Functional Fitness**: Real-world movement patterns
+            """
+        },
+        "emergency": {
+            "fractured": f"""
+**🚨 Emergency Information for Fracture:**
+
+• **Immediate Emergency Signs:**
+  - Severe, unbearable pain
+  - Numbness or tingling in extremities
+  - Blue or cold fingers/toes
+  - Difficulty breathing or chest pain
+  - Fever above 101°F (38°C)
+  - Signs of infection around cast
+
+• **When to Call 911:**
+  - Loss of consciousness
+  - Severe bleeding
+  - Difficulty breathing
+  - Chest pain or pressure
+  - Severe allergic reaction to medication
+
+• **When to Go to ER:**
+  - Cast becomes too tight or uncomfortable
+  - Severe pain not relieved by medication
+  - New numbness or weakness
+  - Signs of infection (redness, warmth, pus)
+  - Cast gets wet and can't be dried
+
+• **Emergency Contacts:**
+  - Primary care physician
+  - Orthopedic specialist
+  - Emergency room
+  - Poison control (if medication issues)
+            """,
+            "normal": f"""
+**🚨 Emergency Information for {bone_type} Health:**
+
+• **Warning Signs to Watch For:**
+  - Sudden, severe pain
+  - Numbness or tingling
+  - Swelling that doesn't improve
+  - Redness or warmth in the area
+  - Fever or chills
+  - Difficulty moving the joint
+
+• **When to Seek Immediate Care:**
+  - Pain that interferes with daily activities
+  - Symptoms that worsen over time
+  - Signs of infection
+  - Trauma or injury to the area
+  - Persistent swelling or bruising
+
+• **When to Call Your Doctor:**
+  - Pain that persists beyond 48 hours
+  - New symptoms develop
+  - Difficulty with normal activities
+  - Concerns about medication side effects
+  - Questions about treatment plan
+
+• **Prevention of Emergencies:**
+  - Regular check-ups
+  - Proper warm-up before activities
+  - Use of protective equipment
+  - Listening to body signals
+  - Avoiding overexertion
+            """
+        },
+        "recovery": {
+            "fractured": f"""
+**📈 Recovery Timeline for Fracture:**
+
+• **Week 1-2 (Acute Phase):**
+  - Focus on pain management
+  - Keep cast/splint clean and dry
+  - Elevate limb to reduce swelling
+  - Follow doctor's medication schedule
+  - Attend all medical appointments
+
+• **Week 3-6 (Healing Phase):**
+  - Continue cast care
+  - Begin gentle range of motion (if approved)
+  - Start physical therapy (when prescribed)
+  - Monitor for any complications
+  - Maintain good nutrition
+
+• **Week 7-12 (Rehabilitation Phase):**
+  - Cast removal (if applicable)
+  - Intensive physical therapy
+  - Gradual return to activities
+  - Strength and flexibility training
+  - Follow-up X-rays as scheduled
+
+• **Month 3+ (Return to Activity):**
+  - Full range of motion exercises
+  - Sport-specific training
+  - Gradual return to normal activities
+  - Continued strength training
+  - Regular follow-up appointments
+
+• **Recovery Milestones:**
+  - Pain-free movement
+  - Full range of motion
+  - Normal strength
+  - Return to daily activities
+  - Return to sports/work
+            """,
+            "normal": f"""
+**📈 Recovery & Prevention Timeline:**
+
+• **Immediate (0-48 hours):**
+  - Rest the affected area
+  - Apply ice if needed
+  - Monitor symptoms
+  - Avoid aggravating activities
+  - Gentle stretching if approved
+
+• **Short-term (1-2 weeks):**
+  - Gradual return to activities
+  - Continue gentle exercises
+  - Monitor for any changes
+  - Maintain good posture
+  - Follow prevention guidelines
+
+• **Long-term (1-3 months):**
+  - Regular exercise routine
+  - Strength training program
+  - Flexibility maintenance
+  - Lifestyle modifications
+  - Regular check-ups
+
+• **Ongoing Prevention:**
+  - Maintain healthy lifestyle
+  - Regular exercise
+  - Proper nutrition
+  - Stress management
+  - Regular medical check-ups
+
+• **Success Indicators:**
+  - Pain-free movement
+  - Normal range of motion
+  - Good strength and flexibility
+  - No recurring symptoms
+  - Improved overall health
+            """
+        }
+    }
+
+
+def section_response(section, bone_type, prediction):
+    return section_responses(bone_type)[section][prediction]
+
+
+# General context for the Gemma model
+# Recent conversation as "Patient:/Assistant:" lines for the prompt. Only the
+# last max_messages turns are kept and long answers (e.g. the canned
+# sections) are cut to max_chars, so the prompt stays bounded however long
+# the chat gets.
+def format_history(history, max_messages=CHAT_CONTEXT_MESSAGES, max_chars=CHAT_CONTEXT_CHARS):
+    lines = []
+    for message in history[-max_messages:] if max_messages > 0 else []:
+        content = " ".join(message["content"].split())
+        if len(content) > max_chars:
+            content = content[:max_chars].rstrip() + "..."
+        speaker = "Patient" if message["role"] == "user" else "Assistant"
+        lines.append(f"{speaker}: {content}")
+    return "\n".join(lines)
+
+
+def build_prompt(bone_type, prediction, prompt, history=None):
+    conversation = format_history(history) if history else ""
+    if conversation:
+        conversation = f"Conversation so far:\n{conversation}\n"
+    return f"""
+            You are a medical assistant helping a patient with their X-ray results.
+            The patient's {bone_type} appears to be {prediction}.
+            {conversation}The patient asked: {prompt}
+            
+            Provide a helpful, professional response with medical advice appropriate for this case.
+            If the bone is fractured, include first aid measures and when to see a doctor.
+            If normal, suggest self-care measures and when to consult if symptoms persist.
+            
+            You can also mention that they can ask about specific topics like:
+            - "all" for complete comprehensive guide
+            - "suggestions" for treatment and recovery tips
+            - "precautions" for safety measures
+            - "food" for dietary recommendations
+            - "medicine" for medication guidelines
+            - "exercise" for physical activity recommendations
+            - "emergency" for emergency signs and when to seek help
+            - "recovery" for recovery timeline and progress
+            """
+
+
+# Chat message that opens the conversation about a new analysis
+def analysis_message(bone_type, prediction, views=1):
+    if views == 1:
+        message = f"{ANALYSIS_MESSAGE_PREFIX} your {bone_type} X-ray. "
+    else:
+        message = f"{ANALYSIS_MESSAGE_PREFIX} the {views} views of your {bone_type} X-ray. "
+    if prediction == 'fractured':
+        return message + "It appears to be fractured. Please ask me any questions about treatment and care."
+    return message + "No fracture was detected. Feel free to ask me any questions."
+
+
+# True when the patient has not asked anything since the latest analysis
+# message, so the answer depends only on the finding and the question and
+# can be shared between sessions through the response cache
+def is_opening_question(history):
+    for message in reversed(history or []):
+        if message["role"] == "user":
+            return False
+        if message["content"].startswith(ANALYSIS_MESSAGE_PREFIX):
+            return True
+    return True
+
+
+# Answer that needs no LLM: a keyword section, else a cached answer for the
+# same finding and question. None means the question needs the LLM. The
+# cache is only used for opening questions: follow-up answers depend on the
+# conversation and must not leak into other sessions.
+def quick_answer(prompt, bone_type, prediction, cache=None, history=None):
+    section = detect_section(prompt)
+    if section:
+        return section_response(section, bone_type, prediction)
+    if cache is not None and is_opening_question(history):
+        return cache.get(bone_type, prediction, prompt)
+    return None
+
+
+# Free-text answer from the assistant worker, admitted through `gate` (an
+# admission.AdmissionController, may raise Overloaded). Opening questions
+# are answered without the conversation so far (earlier analyses included)
+# and cached on success.
+@tracing.traced("assistant.llm_answer")
+def llm_answer(prompt, bone_type, prediction, client, cache=None, gate=None, history=None):
+    opening = is_opening_question(history)
+    context = build_prompt(bone_type, prediction, prompt, history=None if opening else history)
+    with gate.admit() if gate is not None else nullcontext():
+        answer = client.generate(context, max_new_tokens=150, temperature=0.7)
+    if cache is not None and opening:
+        cache.put(bone_type, prediction, prompt, answer)
+    return answer
+
+
+# Order- and filler-insensitive form of a question, e.g. "Can I drive a
+# car?" and "can I drive my car" both become "car drive"
+def normalize_question(question):
+    words = re.findall(r"[a-z0-9]+", question.lower().replace("'", ""))
+    tokens = set()
+    for word in words:
+        if word in _STOPWORDS:
+            continue
+        if len(word) > 4 and word.endswith("ing"):
+            word = word[:-3]
+        elif len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        tokens.add(word)
+    return " ".join(sorted(tokens))
+
+
+# LRU + TTL cache of assistant answers keyed on (bone, prediction,
+# normalized question), shared by all sessions; only answers to opening
+# questions (see is_opening_question) are stored in it
+class ResponseCache:
+    def __init__(self, max_size=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # key -> (stored_at, answer)
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+
+    @staticmethod
+    def key(bone_type, prediction, question):
+        return (bone_type, prediction, normalize_question(question))
+
+    def get(self, bone_type, prediction, question):
+        key = self.key(bone_type, prediction, question)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] > self.ttl:
+                del self._entries[key]
+                self._stats["expirations"] += 1
+                entry = None
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return entry[1]
+
+    def put(self, bone_type, prediction, question, answer):
+        key = self.key(bone_type, prediction, question)
+        with self._lock:
+            self._entries[key] = (time.monotonic(), answer)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats, size=len(self._entries))
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
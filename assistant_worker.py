@@ -0,0 +1,359 @@
+# Gemma assistant as a separate worker process.
+#
+# The GUI never imports torch/transformers. The first free-text question
+# spawns this worker, which loads Gemma and serves generation requests over
+# a local multiprocessing connection (TCP on 127.0.0.1 with an auth key).
+# Keyword-section answers are served from assistant.py and never reach it.
+import multiprocessing
+import os
+import secrets
+import threading
+import time
+from collections import deque
+from multiprocessing.connection import Client, Listener
+
+import tracing
+
+GEMMA_MODEL_ID = os.environ.get("GEMMA_MODEL_ID", "google/gemma-2-2b-it")
+# "gemma", or "stub" for canned replies without torch (offline load tests)
+ASSISTANT_BACKEND = os.environ.get("ASSISTANT_BACKEND", "gemma")
+# seconds a stub batch "decodes" for
+ASSISTANT_STUB_LATENCY = float(os.environ.get("ASSISTANT_STUB_LATENCY", "1.5"))
+# seconds the GUI waits for an answer (includes the one-off model load)
+ASSISTANT_TIMEOUT = float(os.environ.get("ASSISTANT_TIMEOUT", "600"))
+# per-request deadline once the model is loaded (queue wait + decoding)
+GENERATION_TIMEOUT = float(os.environ.get("GENERATION_TIMEOUT", "120"))
+GENERATION_MAX_BATCH = int(os.environ.get("GENERATION_MAX_BATCH", "8"))
+GENERATION_BATCH_WINDOW = float(os.environ.get("GENERATION_BATCH_WINDOW", "0.05"))
+
+
+# Initialize Gemma model (CPU version). The Gemma weights are gated on the
+# Hugging Face Hub; the access token is read from HF_TOKEN by huggingface_hub
+# (or from a cached `huggingface-cli login`), never from this code.
+def load_gemma_model():
+    import torch
+    from transformers import AutoTokenizer, AutoModelForCausalLM
+
+    try:
+        tokenizer = AutoTokenizer.from_pretrained(GEMMA_MODEL_ID)
+    except OSError as e:
+        if not os.environ.get("HF_TOKEN") and ("gated" in str(e) or "401" in str(e)):
+            raise RuntimeError(f"{GEMMA_MODEL_ID} is a gated model: set HF_TOKEN to a Hugging Face token "
+                               f"with access to it (or run `huggingface-cli login`)") from e
+        raise
+    model = AutoModelForCausalLM.from_pretrained(
+        GEMMA_MODEL_ID,
+        torch_dtype=torch.bfloat16,
+        device_map="cpu"
+    )
+    return tokenizer, model
+
+
+# Left-padded batch generation; returns the new token ids of every row
+def generate_batch(tokenizer, model, prompts, max_new_tokens=150, temperature=0.7, max_time=None):
+    tokenizer.padding_side = "left"
+    encoded = tokenizer(prompts, return_tensors="pt", padding=True).to("cpu")
+    output = model.generate(**encoded, max_new_tokens=max_new_tokens, temperature=temperature,
+                            max_time=max_time, pad_token_id=tokenizer.pad_token_id)
+    return output[:, encoded["input_ids"].shape[1]:]
+
+
+class _Request:
+    def __init__(self, prompt, max_new_tokens, temperature, timeout):
+        self.prompt = prompt
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.submitted = time.monotonic()
+        self.deadline = self.submitted + timeout
+        self.reply = None
+        self._done = threading.Event()
+
+    def finish(self, reply):
+        self.reply = reply
+        self._done.set()
+
+    def wait(self):
+        self._done.wait()
+        return self.reply
+
+
+# Batches prompts from concurrent chat sessions into one padded generate()
+# call. A batch is cut when it is full or batch_window seconds after its
+# first request arrived; requests only share a batch with the same
+# temperature. Each request keeps its own max_new_tokens (the batch decodes
+# to the largest and rows are truncated) and deadline (expired requests are
+# dropped before decoding, and the batch's max_time is the earliest
+# remaining deadline).
+class GenerationScheduler:
+    def __init__(self, tokenizer, model, max_batch=GENERATION_MAX_BATCH,
+                 batch_window=GENERATION_BATCH_WINDOW):
+        self.tokenizer = tokenizer
+        self.model = model
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._stats_lock = threading.Lock()
+        self._stats = {"requests": 0, "batches": 0, "timeouts": 0, "errors": 0,
+                       "tokens": 0, "generation_seconds": 0.0}
+        self._queue_waits = deque(maxlen=1000)
+        self._thread = threading.Thread(target=self._run, name="generation-scheduler", daemon=True)
+        self._thread.start()
+
+    def submit(self, prompt, max_new_tokens=150, temperature=0.7, timeout=GENERATION_TIMEOUT):
+        request = _Request(prompt, max_new_tokens, temperature, timeout)
+        with self._cond:
+            self._queue.append(request)
+            self._cond.notify()
+        return request.wait()
+
+    def _take_batch(self):
+        with self._cond:
+            while not self._queue:
+                self._cond.wait()
+            cutoff = self._queue[0].submitted + self.batch_window
+            while len(self._queue) < self.max_batch:
+                remaining = cutoff - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            temperature = self._queue[0].temperature
+            batch, skipped = [], []
+            while self._queue and len(batch) < self.max_batch:
+                request = self._queue.popleft()
+                (batch if request.temperature == temperature else skipped).append(request)
+            self._queue.extendleft(reversed(skipped))
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            now = time.monotonic()
+            live = []
+            for request in batch:
+                if now >= request.deadline:
+                    request.finish({"error": "timed out waiting in the generation queue"})
+                    with self._stats_lock:
+                        self._stats["timeouts"] += 1
+                else:
+                    live.append(request)
+            if not live:
+                continue
+
+            started = time.monotonic()
+            try:
+                rows = generate_batch(
+                    self.tokenizer, self.model, [r.prompt for r in live],
+                    max_new_tokens=max(r.max_new_tokens for r in live),
+                    temperature=live[0].temperature,
+                    max_time=min(r.deadline for r in live) - started,
+                )
+            except Exception as e:
+                for request in live:
+                    request.finish({"error": str(e)})
+                with self._stats_lock:
+                    self._stats["errors"] += len(live)
+                continue
+            elapsed = time.monotonic() - started
+
+            pad_id = self.tokenizer.pad_token_id
+            batch_tokens = 0
+            queue_waits = []
+            for request, row in zip(live, rows):
+                row = row[:request.max_new_tokens]
+                n_tokens = int((row != pad_id).sum())
+                batch_tokens += n_tokens
+                queue_wait = started - request.submitted
+                queue_waits.append(queue_wait)
+                request.finish({
+                    "text": self.tokenizer.decode(row, skip_special_tokens=True).strip(),
+                    "tokens": n_tokens,
+                    "queue_wait": queue_wait,
+                    "generation_time": elapsed,
+                    "batch_size": len(live),
+                })
+            with self._stats_lock:
+                self._stats["requests"] += len(live)
+                self._stats["batches"] += 1
+                self._stats["tokens"] += batch_tokens
+                self._stats["generation_seconds"] += elapsed
+                self._queue_waits.extend(queue_waits)
+
+    # Aggregate throughput and queue-wait percentiles
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+            waits = sorted(self._queue_waits)
+        stats["queue_depth"] = len(self._queue)
+        stats["avg_batch_size"] = stats["requests"] / stats["batches"] if stats["batches"] else 0.0
+        stats["tokens_per_sec"] = (stats["tokens"] / stats["generation_seconds"]
+                                   if stats["generation_seconds"] else 0.0)
+        for q in (50, 95):
+            stats[f"queue_wait_p{q}"] = waits[min(len(waits) - 1, len(waits) * q // 100)] if waits else 0.0
+        return stats
+
+
+# Stand-in for GenerationScheduler that needs no model: every request sleeps
+# for `latency` seconds and gets a canned reply with the same fields. Used by
+# loadtest.py so the harness runs offline; the worker round trip is real.
+class StubScheduler:
+    def __init__(self, latency=ASSISTANT_STUB_LATENCY):
+        self.latency = latency
+        self._stats_lock = threading.Lock()
+        self._stats = {"requests": 0, "batches": 0, "timeouts": 0, "errors": 0,
+                       "tokens": 0, "generation_seconds": 0.0}
+
+    def submit(self, prompt, max_new_tokens=150, temperature=0.7, timeout=GENERATION_TIMEOUT):
+        started = time.monotonic()
+        time.sleep(min(self.latency, timeout))
+        elapsed = time.monotonic() - started
+        tokens = min(max_new_tokens, 40)
+        with self._stats_lock:
+            self._stats["requests"] += 1
+            self._stats["batches"] += 1
+            self._stats["tokens"] += tokens
+            self._stats["generation_seconds"] += elapsed
+        return {"text": "This is a placeholder answer from the stub assistant backend.",
+                "tokens": tokens, "queue_wait": 0.0, "generation_time": elapsed, "batch_size": 1}
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["queue_depth"] = 0
+        stats["avg_batch_size"] = 1.0 if stats["batches"] else 0.0
+        stats["tokens_per_sec"] = (stats["tokens"] / stats["generation_seconds"]
+                                   if stats["generation_seconds"] else 0.0)
+        stats["queue_wait_p50"] = stats["queue_wait_p95"] = 0.0
+        return stats
+
+
+def _handle(conn, ready, state):
+    try:
+        request = conn.recv()
+        if request.get("op") == "stats":
+            scheduler = state.get("scheduler")
+            conn.send(scheduler.stats() if scheduler else {"loading": True})
+            return
+        # the caller's trace context, so these spans join its request
+        with tracing.span("assistant_worker.request", correlation_id=request.get("trace_id"),
+                          parent_id=request.get("parent_span")) as info:
+            with tracing.span("assistant_worker.wait_for_model"):
+                ready.wait()
+            if "error" in state:
+                conn.send({"error": state["error"]})
+                return
+            reply = state["scheduler"].submit(
+                request["prompt"],
+                max_new_tokens=request.get("max_new_tokens", 150),
+                temperature=request.get("temperature", 0.7),
+                timeout=request.get("timeout", GENERATION_TIMEOUT),
+            )
+            if "error" in reply:
+                info["error"] = reply["error"]
+            else:
+                tracing.add_span("assistant_worker.queue", reply["queue_wait"], ago=reply["generation_time"])
+                tracing.add_span("assistant_worker.generate", reply["generation_time"],
+                                 batch_size=reply["batch_size"], tokens=reply["tokens"])
+            conn.send(reply)
+    except (EOFError, OSError):
+        pass
+    finally:
+        conn.close()
+
+
+# Worker entry point. The listener is bound before the model loads so the
+# parent learns the address immediately; requests wait until Gemma is ready
+# (so their queue deadlines don't include the one-off load).
+def serve(ready_conn, authkey):
+    listener = Listener(("127.0.0.1", 0), authkey=authkey)
+    ready_conn.send(listener.address)
+    ready_conn.close()
+
+    ready = threading.Event()
+    state = {}
+
+    def _load():
+        try:
+            if ASSISTANT_BACKEND == "stub":
+                state["scheduler"] = StubScheduler()
+                return
+            tokenizer, model = load_gemma_model()
+            state["scheduler"] = GenerationScheduler(tokenizer, model)
+        except Exception as e:
+            state["error"] = f"Failed to load {GEMMA_MODEL_ID}: {e}"
+        finally:
+            ready.set()
+
+    threading.Thread(target=_load, name="gemma-load", daemon=True).start()
+    while True:
+        conn = listener.accept()
+        threading.Thread(target=_handle, args=(conn, ready, state), daemon=True).start()
+
+
+# GUI-side handle. Creating it is free; the worker process is spawned on the
+# first generate() call. Each call uses its own connection, so one client
+# can be shared by all Streamlit sessions.
+class AssistantClient:
+    def __init__(self, timeout=ASSISTANT_TIMEOUT):
+        self.timeout = timeout
+        self._authkey = secrets.token_bytes(32)
+        self._address = None
+        self._process = None
+        self._lock = threading.Lock()
+
+    # Worker process id, for memory monitoring
+    @property
+    def pid(self):
+        return self._process.pid if self.started else None
+
+    @property
+    def started(self):
+        return self._process is not None and self._process.is_alive()
+
+    def ensure_started(self):
+        with self._lock:
+            if self.started:
+                return
+            ctx = multiprocessing.get_context("spawn")
+            parent_conn, child_conn = ctx.Pipe(duplex=False)
+            self._process = ctx.Process(target=serve, args=(child_conn, self._authkey),
+                                        name="gemma-worker", daemon=True)
+            self._process.start()
+            child_conn.close()
+            self._address = parent_conn.recv()
+            parent_conn.close()
+
+    def _request(self, message, timeout):
+        with Client(self._address, authkey=self._authkey) as conn:
+            conn.send(message)
+            if not conn.poll(timeout):
+                raise TimeoutError(f"Assistant did not answer within {timeout:.0f}s")
+            return conn.recv()
+
+    # Full reply: text plus tokens, queue_wait, generation_time and batch_size
+    @tracing.traced("assistant.generate")
+    def generate_reply(self, prompt, max_new_tokens=150, temperature=0.7, timeout=GENERATION_TIMEOUT):
+        with tracing.span("assistant.start_worker"):
+            self.ensure_started()
+        trace_id, parent_span = tracing.current_context()
+        reply = self._request({"prompt": prompt, "max_new_tokens": max_new_tokens,
+                               "temperature": temperature, "timeout": timeout,
+                               "trace_id": trace_id, "parent_span": parent_span}, self.timeout)
+        if "error" in reply:
+            raise RuntimeError(reply["error"])
+        return reply
+
+    def generate(self, prompt, max_new_tokens=150, temperature=0.7, timeout=GENERATION_TIMEOUT):
+        return self.generate_reply(prompt, max_new_tokens, temperature, timeout)["text"]
+
+    # Scheduler metrics from the worker, or None if it hasn't been started
+    def stats(self):
+        if not self.started:
+            return None
+        return self._request({"op": "stats"}, 10)
+
+    def stop(self):
+        with self._lock:
+            if self._process is not None:
+                self._process.terminate()
+                self._process = None
@@ -0,0 +1,129 @@
+# Batch size and TensorFlow thread autotuner for the CPU inference path.
+#
+#   python autotune.py test.zip
+#   python autotune.py test.zip --batch-sizes 1,8,16,32,64 --intra 4,8 --inter 1,2
+#
+# Thread counts can only be set before TensorFlow initializes, so every
+# (intra-op, inter-op) pair is measured in a fresh subprocess, which sweeps
+# the batch sizes on the Parts model plus one fracture model (the cost of
+# the cascade for a routed image). The configuration with the highest
+# throughput is saved under this node type's key (CPU model and core count,
+# or AUTOTUNE_HOST_KEY) in AUTOTUNE_PATH, where
+# predictions.inference_config() picks it up on the next start on any node
+# of that type.
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+import predictions
+
+
+def _candidates(value, default):
+    return [int(v) for v in value.split(",")] if value else default
+
+
+def _default_threads():
+    cores = os.cpu_count() or 1
+    return sorted({max(1, cores // d) for d in (1, 2, 4)}, reverse=True)
+
+
+# Child mode: images/sec of Parts + fracture model for each batch size under
+# the thread counts given in the environment, printed as JSON
+def measure(args):
+    paths = predictions.collect_images(args.images)[:args.limit]
+    if not paths:
+        raise SystemExit(f"No images found in {args.images}")
+    x = np.stack([predictions.load_tensor(p) for p in paths])
+    models = predictions.current_models()
+    pipeline = [models.get("Parts"), models.get(args.model)]
+
+    throughput = {}
+    for batch_size in _candidates(args.batch_sizes, []):
+        for m in pipeline:
+            m.predict(x[:batch_size], verbose=0, batch_size=batch_size)
+        timings = []
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            for m in pipeline:
+                m.predict(x, verbose=0, batch_size=batch_size)
+            timings.append(time.perf_counter() - start)
+        throughput[batch_size] = len(x) / float(np.median(timings))
+    print(json.dumps(throughput))
+
+
+def _run_child(args, intra, inter):
+    env = dict(os.environ, TF_INTRA_OP_THREADS=str(intra), TF_INTER_OP_THREADS=str(inter),
+               TF_CPP_MIN_LOG_LEVEL="2")
+    command = [sys.executable, os.path.abspath(__file__), args.images, "--measure",
+               "--batch-sizes", args.batch_sizes, "--model", args.model,
+               "--limit", str(args.limit), "--repeats", str(args.repeats)]
+    completed = subprocess.run(command, env=env, capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise SystemExit(f"Measurement failed (intra={intra}, inter={inter}):\n{completed.stderr[-2000:]}")
+    return {int(k): v for k, v in json.loads(completed.stdout.strip().splitlines()[-1]).items()}
+
+
+def save_config(config, path=None):
+    path = path or predictions.AUTOTUNE_PATH
+    tuned = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            tuned = json.load(f)
+    tuned[predictions.host_key()] = config
+    with open(path, "w") as f:
+        json.dump(tuned, f, indent=2)
+
+
+def tune(args):
+    intra_values = _candidates(args.intra, _default_threads())
+    inter_values = _candidates(args.inter, [1, 2])
+    rows, best = [], None
+    for intra in intra_values:
+        for inter in inter_values:
+            for batch_size, rate in _run_child(args, intra, inter).items():
+                rows.append([intra, inter, batch_size, f"{rate:.1f}"])
+                if best is None or rate > best["images_per_sec"]:
+                    best = {"batch_size": batch_size, "intra_op_threads": intra,
+                            "inter_op_threads": inter, "images_per_sec": round(rate, 2)}
+
+    widths = [max(len(str(v)) for v in col) for col in zip(["intra", "inter", "batch", "img/s"], *rows)]
+    for row in [["intra", "inter", "batch", "img/s"]] + rows:
+        print("  ".join(str(v).rjust(w) for v, w in zip(row, widths)))
+
+    best.update({"cpu_count": os.cpu_count(), "model_version": predictions.model_version(),
+                 "tuned_at": time.strftime("%Y-%m-%dT%H:%M:%S")})
+    if not args.dry_run:
+        save_config(best, args.output)
+    print(f"Best for {predictions.host_key()}: batch {best['batch_size']}, "
+          f"intra {best['intra_op_threads']}, inter {best['inter_op_threads']} "
+          f"({best['images_per_sec']} img/s)" + ("" if args.dry_run else
+                                               f" -> {args.output or predictions.AUTOTUNE_PATH}"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tune inference batch size and TF thread counts for this node type")
+    parser.add_argument("images", help="directory or .zip of representative X-rays (e.g. test.zip)")
+    parser.add_argument("--batch-sizes", default="1,4,8,16,32,64")
+    parser.add_argument("--intra", help="comma-separated intra-op thread counts (default: cores, cores/2, cores/4)")
+    parser.add_argument("--inter", help="comma-separated inter-op thread counts (default: 1,2)")
+    parser.add_argument("--model", default="Hand", help="fracture model timed after Parts")
+    parser.add_argument("--limit", type=int, default=64, help="images per measurement")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--output", help=f"autotune file (default {predictions.AUTOTUNE_PATH})")
+    parser.add_argument("--dry-run", action="store_true", help="print the best configuration without saving it")
+    parser.add_argument("--measure", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        measure(args)
+    else:
+        tune(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+# Batch analysis CLI backed by the persistent result store.
+#
+#   python batch_analyze.py test.zip --batch-size 32 --output results.jsonl
+#   python batch_analyze.py --query --bone Hand --label fractured
+#
+# Images whose result is already stored (same content hash and options) are
+# answered from the store; only new images go through the batched cascade.
+import argparse
+import json
+import time
+
+from result_store import RESULT_STORE_PATH, ResultStore
+
+
+def _options(args):
+    options = {}
+    if args.tta:
+        options["tta"] = args.tta
+    if args.policy:
+        options["low_confidence_policy"] = args.policy
+    if args.tiled:
+        options["tiled"] = args.tiled
+    return options
+
+
+def run_batch(args, store):
+    import predictions
+    from dedup import DedupIndex
+
+    paths = []
+    for source in args.images:
+        paths.extend(predictions.collect_images(source))
+    if not paths:
+        raise SystemExit("No images found")
+
+    index = DedupIndex(store=store)
+    options = _options(args)
+    start = time.perf_counter()
+    output = open(args.output, "w") if args.output else None
+    try:
+        for offset in range(0, len(paths), args.batch_size):
+            chunk = paths[offset:offset + args.batch_size]
+            for path, result in zip(chunk, index.analyze_many(chunk, **options)):
+                line = json.dumps(dict(result, path=path))
+                if output:
+                    output.write(line + "\n")
+                else:
+                    print(line)
+    finally:
+        if output:
+            output.close()
+
+    stats = index.stats()
+    elapsed = time.perf_counter() - start
+    print(f"{len(paths)} images in {elapsed:.1f}s: {stats['misses'] - stats['rejected']} analyzed, "
+          f"{stats['rejected']} rejected by the pre-filter, "
+          f"{stats['exact_hits']} exact and {stats['near_hits']} near duplicates reused")
+
+
+def run_query(args, store):
+    for row in store.query(bone=args.bone, label=args.label, since=args.since, limit=args.limit):
+        print(json.dumps(row))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyze X-rays in bulk through the result store")
+    parser.add_argument("images", nargs="*", help="image or DICOM files, directories or .zip archives")
+    parser.add_argument("--store", default=RESULT_STORE_PATH, help="SQLite result store")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--output", help="write JSON lines here instead of stdout")
+    parser.add_argument("--tta", type=int, default=0, help="test-time augmentation views")
+    parser.add_argument("--policy", choices=["all", "review"], help="low-confidence routing policy")
+    parser.add_argument("--tiled", choices=["off", "borderline", "all"],
+                        help="re-score images as full-resolution tiles")
+    parser.add_argument("--query", action="store_true", help="list stored studies instead of analyzing")
+    parser.add_argument("--bone", help="with --query: Elbow, Hand or Shoulder")
+    parser.add_argument("--label", help="with --query: fractured, normal or review")
+    parser.add_argument("--since", type=float, help="with --query: unix timestamp lower bound")
+    parser.add_argument("--limit", type=int, default=100)
+    args = parser.parse_args()
+
+    store = ResultStore(args.store)
+    try:
+        if args.query:
+            run_query(args, store)
+        else:
+            run_batch(args, store)
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+# Latency benchmarks for the inference path.
+#
+#   python benchmark.py tta test.zip --views 1,2,4,8
+#   python benchmark.py tiles test.zip --grids 1,2,3,4
+#   python benchmark.py import-time
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+
+def _percentile_ms(timings, q):
+    return float(np.percentile(timings, q)) * 1000
+
+
+def _print_table(header, rows):
+    widths = [max(len(str(v)) for v in col) for col in zip(header, *rows)]
+    for row in [header] + rows:
+        print("  ".join(str(v).rjust(w) for v, w in zip(row, widths)))
+
+
+# Per-image latency of the TTA path against the number of views K. Each
+# image's K views go through the model as one batch, so cost should grow
+# well below K x the single-view latency.
+def bench_tta(args):
+    import predictions
+
+    paths = predictions.collect_images(args.images)[:args.limit]
+    if not paths:
+        raise SystemExit(f"No images found in {args.images}")
+    ks = [int(k) for k in args.views.split(",")]
+    chosen_model = predictions.get_model(args.model)
+    x = np.stack([predictions.load_tensor(p) for p in paths])
+
+    # warm-up so graph tracing is not billed to the first K
+    for k in sorted(set(ks)):
+        if k > 1:
+            predictions.predict_tta(chosen_model, x[:1], k)
+        else:
+            chosen_model.predict(x[:1], verbose=0)
+
+    rows = []
+    baseline = None
+    for k in ks:
+        timings = []
+        for _ in range(args.repeats):
+            for i in range(len(x)):
+                start = time.perf_counter()
+                if k > 1:
+                    predictions.predict_tta(chosen_model, x[i:i + 1], k)
+                else:
+                    chosen_model.predict(x[i:i + 1], verbose=0)
+                timings.append(time.perf_counter() - start)
+        p50 = _percentile_ms(timings, 50)
+        baseline = baseline or p50
+        rows.append([k, f"{p50:.1f}", f"{_percentile_ms(timings, 95):.1f}",
+                     f"{p50 / baseline:.2f}x", f"{p50 / k:.1f}"])
+
+    print(f"TTA latency, model={args.model}, {len(x)} images x {args.repeats} repeats")
+    _print_table(["K", "p50 ms", "p95 ms", "vs K=1", "ms/view"], rows)
+
+
+# Per-image latency of tiled inference against the tile grid: reading the
+# source at full resolution and cutting the tiles (prep), then scoring all
+# grid x grid tiles in one predict call, next to the single 224x224 view.
+def bench_tiles(args):
+    import predictions
+
+    paths = predictions.collect_images(args.images)[:args.limit]
+    if not paths:
+        raise SystemExit(f"No images found in {args.images}")
+    grids = [int(g) for g in args.grids.split(",")]
+    chosen_model = predictions.get_model(args.model)
+    batch_size = predictions.inference_config()["batch_size"]
+
+    # warm-up so graph tracing is not billed to the first grid
+    chosen_model.predict(predictions.load_tensor(paths[0])[None], verbose=0)
+    chosen_model.predict(predictions.tile_tensors(paths[0], max(grids), args.overlap)[0], verbose=0,
+                         batch_size=batch_size)
+
+    baseline = []
+    for _ in range(args.repeats):
+        for path in paths:
+            start = time.perf_counter()
+            chosen_model.predict(predictions.load_tensor(path)[None], verbose=0)
+            baseline.append(time.perf_counter() - start)
+    base_p50 = _percentile_ms(baseline, 50)
+    rows = [["whole", 1, "-", f"{base_p50:.1f}", f"{_percentile_ms(baseline, 95):.1f}", "1.0x"]]
+
+    for grid in grids:
+        prep, total = [], []
+        for _ in range(args.repeats):
+            for path in paths:
+                start = time.perf_counter()
+                tiles, _ = predictions.tile_tensors(path, grid, args.overlap)
+                prep.append(time.perf_counter() - start)
+                chosen_model.predict(tiles, verbose=0, batch_size=batch_size)
+                total.append(time.perf_counter() - start)
+        p50 = _percentile_ms(total, 50)
+        rows.append([f"{grid}x{grid}", grid * grid, f"{_percentile_ms(prep, 50):.1f}", f"{p50:.1f}",
+                     f"{_percentile_ms(total, 95):.1f}", f"{p50 / base_p50:.1f}x"])
+
+    print(f"{args.model}, {len(paths)} images x {args.repeats} repeats, overlap {args.overlap}")
+    _print_table(["grid", "tiles", "prep p50 ms", "p50 ms", "p95 ms", "vs whole"], rows)
+
+
+# Frameworks that must only be imported on the code paths that run a model
+HEAVY_IMPORTS = ("tensorflow", "keras", "torch", "transformers")
+IMPORT_TIME_MODULES = ("predictions", "dedup", "result_store", "dicom_input", "embedding_index",
+                       "admission", "assistant", "assistant_worker", "batch_analyze", "evaluate", "inbox_watcher",
+                       "autotune", "loadtest", "prefilter", "tracing")
+
+
+# (cumulative import time in seconds, set of top-level packages imported)
+# for `import module` in a fresh interpreter, from -X importtime
+def _import_profile(module):
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    if completed.returncode != 0:
+        raise SystemExit(f"import {module} failed:\n{completed.stderr[-2000:]}")
+    cumulative, packages = None, set()
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative_us, name = line.split("|")
+        if not cumulative_us.strip().isdigit():
+            continue    # header line
+        packages.add(name.strip().split(".")[0])
+        if name.strip() == module and not name[1:].startswith(" "):
+            cumulative = int(cumulative_us) / 1e6
+    return cumulative, packages
+
+
+# Import time of each module in a fresh interpreter (best of --repeats).
+# Fails if any of them pulls in TensorFlow/Keras/torch/transformers or takes
+# longer than --budget-ms, so it can guard startup time in CI.
+def bench_import_time(args):
+    modules = args.modules.split(",") if args.modules else IMPORT_TIME_MODULES
+    rows, failures = [], []
+    for module in modules:
+        timings, heavy = [], set()
+        for _ in range(args.repeats):
+            cumulative, packages = _import_profile(module)
+            timings.append(cumulative or 0.0)
+            heavy |= packages & set(HEAVY_IMPORTS)
+        ms = min(timings) * 1000
+        status = "ok"
+        if heavy:
+            status = "imports " + ",".join(sorted(heavy))
+        elif ms > args.budget_ms:
+            status = f"over {args.budget_ms:.0f} ms budget"
+        if status != "ok":
+            failures.append(module)
+        rows.append([module, f"{ms:.1f}", status])
+
+    print(f"Import time, best of {args.repeats}")
+    _print_table(["module", "ms", "status"], rows)
+    if failures:
+        raise SystemExit(f"Import-time check failed for: {', '.join(failures)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inference latency benchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    tta = sub.add_parser("tta", help="latency cost of test-time augmentation against K")
+    tta.add_argument("images", help="directory or .zip of X-ray images (e.g. test.zip)")
+    tta.add_argument("--model", default="Hand", help="Parts, Elbow, Hand or Shoulder")
+    tta.add_argument("--views", default="1,2,4,8", help="comma-separated K values")
+    tta.add_argument("--limit", type=int, default=16, help="max images to score")
+    tta.add_argument("--repeats", type=int, default=3)
+    tta.set_defaults(func=bench_tta)
+
+    tiles = sub.add_parser("tiles", help="latency of tiled inference against the tile grid")
+    tiles.add_argument("images", help="directory or .zip of X-ray images (e.g. test.zip)")
+    tiles.add_argument("--model", default="Hand", help="fracture model to score the tiles")
+    tiles.add_argument("--grids", default="1,2,3,4", help="comma-separated tile grid sizes")
+    tiles.add_argument("--overlap", type=float, default=0.25, help="tile overlap as a fraction of the side")
+    tiles.add_argument("--limit", type=int, default=16, help="max images to score")
+    tiles.add_argument("--repeats", type=int, default=3)
+    tiles.set_defaults(func=bench_tiles)
+
+    imports = sub.add_parser("import-time", help="fail if modules import heavy frameworks or start slowly")
+    imports.add_argument("--modules", help="comma-separated modules (default: the app and CLI modules)")
+    imports.add_argument("--budget-ms", type=float, default=1000.0, help="max cumulative import time per module")
+    imports.add_argument("--repeats", type=int, default=3)
+    imports.set_defaults(func=bench_import_time)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
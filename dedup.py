@@ -0,0 +1,264 @@
+# Deduplication index in front of analyze_image.
+#
+# A submission is looked up first by an exact content hash (sha256 of the
+# uploaded bytes), then by a 64-bit perceptual hash of the 224x224
+# preprocessed tensor. A hit returns the stored result without running any
+# model; only misses go through the cascade.
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import nullcontext
+
+import numpy as np
+
+import predictions
+import prefilter
+import tracing
+from result_store import options_key
+
+# Max Hamming distance (out of 64 bits) for two images to count as near-duplicates
+PHASH_MAX_DISTANCE = 4
+DEDUP_MAX_ENTRIES = 50000
+
+_HASH_SIZE = 8
+_DCT_SIZE = 32
+
+
+def _dct_matrix(n):
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    m = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2.0 / n)
+    m[0] /= np.sqrt(2.0)
+    return m
+
+
+_DCT = _dct_matrix(_DCT_SIZE)
+
+
+# sha256 of the raw upload (bytes) or of the file at a path
+def content_hash(img):
+    if isinstance(img, (bytes, bytearray)):
+        return hashlib.sha256(img).hexdigest()
+    digest = hashlib.sha256()
+    with open(img, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# DCT perceptual hash of a preprocessed (size, size, 3) tensor: grayscale,
+# block-average to 32x32, keep the 8x8 lowest frequencies (minus DC) and
+# threshold them at their median
+def perceptual_hash(x):
+    gray = np.asarray(x, dtype=np.float64).mean(axis=2)
+    size = gray.shape[0]
+    block = size // _DCT_SIZE
+    gray = gray[:block * _DCT_SIZE, :block * _DCT_SIZE]
+    small = gray.reshape(_DCT_SIZE, block, _DCT_SIZE, block).mean(axis=(1, 3))
+    freq = (_DCT @ small @ _DCT.T)[:_HASH_SIZE, :_HASH_SIZE].flatten()
+    bits = freq[1:] > np.median(freq[1:])
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return value
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+# analyze_image options change the result, so entries are kept per option set
+def _variant(kwargs):
+    return options_key(kwargs)
+
+
+# heatmap is not part of the variant; a result computed without one does not
+# answer a caller that wants it and is re-run (the new result replaces it)
+def _covers(result, kwargs):
+    return not kwargs.get("heatmap") or result.get("routing") != "single" or "heatmap" in result
+
+
+class DedupIndex:
+    def __init__(self, max_distance=PHASH_MAX_DISTANCE, max_entries=DEDUP_MAX_ENTRIES, store=None,
+                 admission=None):
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        # optional result_store.ResultStore backing the index across restarts
+        self.store = store
+        # optional admission.AdmissionController limiting concurrent inference;
+        # hits are always answered, misses may raise admission.Overloaded
+        self.admission = admission
+        # Pigeonhole banding: two 63-bit hashes within max_distance bits share at
+        # least one of max_distance + 1 bands exactly, so near-duplicate lookup
+        # only compares against entries colliding on some band.
+        self._n_bands = max_distance + 1
+        self._band_bits = -(-63 // self._n_bands)
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # entry id -> (variant, digest, phash, result)
+        self._exact = {}                # (variant, digest) -> entry id
+        self._bands = {}                # (variant, band, value) -> set of entry ids
+        self._next_id = 0
+        self._stats = {"lookups": 0, "exact_hits": 0, "near_hits": 0, "misses": 0, "rejected": 0}
+        if store is not None:
+            for digest, phash, options, result in store.recent_hashes(max_entries):
+                self.add(digest, phash, result, **options)
+
+    def _band_keys(self, variant, phash):
+        mask = (1 << self._band_bits) - 1
+        return [(variant, b, (phash >> (b * self._band_bits)) & mask) for b in range(self._n_bands)]
+
+    # Entries computed by weights other than the active ones are stale
+    def _is_current(self, entry_id, version):
+        return self._entries[entry_id][3].get("model_version") == version
+
+    def _find_exact(self, variant, digest, version):
+        entry_id = self._exact.get((variant, digest))
+        if entry_id is None or not self._is_current(entry_id, version):
+            return None
+        self._entries.move_to_end(entry_id)
+        return self._entries[entry_id][3]
+
+    def _find_near(self, variant, phash, version):
+        best_id, best_distance = None, self.max_distance + 1
+        for key in self._band_keys(variant, phash):
+            for entry_id in self._bands.get(key, ()):
+                if self._entries[entry_id][2] is None or not self._is_current(entry_id, version):
+                    continue
+                distance = hamming(phash, self._entries[entry_id][2])
+                if distance < best_distance:
+                    best_id, best_distance = entry_id, distance
+        if best_id is None:
+            return None
+        self._entries.move_to_end(best_id)
+        return self._entries[best_id][3]
+
+    def _evict(self):
+        entry_id, (variant, digest, phash, _) = self._entries.popitem(last=False)
+        if self._exact.get((variant, digest)) == entry_id:
+            del self._exact[(variant, digest)]
+        for key in self._band_keys(variant, phash) if phash is not None else ():
+            ids = self._bands.get(key)
+            if ids is not None:
+                ids.discard(entry_id)
+                if not ids:
+                    del self._bands[key]
+
+    def add(self, digest, phash, result, **kwargs):
+        variant = _variant(kwargs)
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (variant, digest, phash, result)
+            self._exact[(variant, digest)] = entry_id
+            if phash is not None:
+                for key in self._band_keys(variant, phash):
+                    self._bands.setdefault(key, set()).add(entry_id)
+            while len(self._entries) > self.max_entries:
+                self._evict()
+
+    # Returns (result, hit) where hit is "exact", "near" or None (miss).
+    # Only results from the currently active model version can hit.
+    def lookup(self, digest, phash=None, **kwargs):
+        variant = _variant(kwargs)
+        version = predictions.model_version()
+        with self._lock:
+            result = self._find_exact(variant, digest, version)
+            if result is not None and _covers(result, kwargs):
+                return result, "exact"
+            if phash is not None:
+                result = self._find_near(variant, phash, version)
+                if result is not None and _covers(result, kwargs):
+                    return result, "near"
+        return None, None
+
+    # Batched drop-in for predictions.analyze_images: hits are answered from
+    # the index (or the persistent store), misses are screened by the
+    # pre-filter before the admission gate, and the rest go through one
+    # cascade call. digests can be passed when the raw upload bytes are at hand (the
+    # GUI re-encodes uploads to PNG); sources are recorded in the store.
+    # embeddings=True attaches the pooled embedding to freshly analyzed
+    # results only; embeddings are never stored or cached.
+    @tracing.traced("dedup.analyze_many")
+    def analyze_many(self, imgs, digests=None, sources=None, embeddings=False, **kwargs):
+        if digests is None:
+            digests = [content_hash(img) for img in imgs]
+        if sources is None:
+            sources = [img if isinstance(img, str) else None for img in imgs]
+        results = [None] * len(imgs)
+        misses, tensors, phashes, hints = [], [], [], []
+        pending = {}    # digest -> index of its first miss in this batch
+        aliases = {}    # in-batch exact repeats -> index of the first copy
+        for i, (img, digest) in enumerate(zip(imgs, digests)):
+            if digest in pending:
+                aliases[i] = pending[digest]
+                with self._lock:
+                    self._stats["lookups"] += 1
+                    self._stats["exact_hits"] += 1
+                continue
+            result, hit = self.lookup(digest, **kwargs)
+            if hit is None and self.store is not None:
+                result = self.store.find_by_hash(digest, kwargs, predictions.model_version())
+                if result is not None and _covers(result, kwargs):
+                    hit = "exact"
+                    self.add(digest, None, result, **kwargs)
+            phash = None
+            if hit is None:
+                with tracing.span("dedup.decode"):
+                    x = predictions.load_tensor(img)
+                    phash = perceptual_hash(x)
+                result, hit = self.lookup(digest, phash, **kwargs)
+            with self._lock:
+                self._stats["lookups"] += 1
+                self._stats[f"{hit}_hits" if hit else "misses"] += 1
+            if hit is not None:
+                results[i] = dict(result, dedup_hit=hit)
+                continue
+            # tensors lose the DICOM header, so routing hints are read from the sources
+            hint = predictions.routing_hint(img)
+            verdict = None
+            if kwargs.get("prefilter_images", prefilter.PREFILTER_ENABLED) and hint is None:
+                verdict = prefilter.screen(x)
+            if verdict is not None and not verdict["accepted"]:
+                # rejections are cheap to recompute, so they are neither indexed nor stored
+                results[i] = dict(prefilter.rejection_result(verdict, predictions.model_version()),
+                                  dedup_hit=None)
+                with self._lock:
+                    self._stats["rejected"] += 1
+            else:
+                pending[digest] = i
+                misses.append(i)
+                tensors.append(x)
+                phashes.append(phash)
+                hints.append(hint)
+
+        if misses:
+            with self.admission.admit() if self.admission is not None else nullcontext():
+                analyzed = predictions.analyze_images(
+                    tensors, bone_hints=hints, tile_sources=[imgs[i] for i in misses],
+                    embeddings=embeddings, **dict(kwargs, prefilter_images=False))
+            for i, phash, result in zip(misses, phashes, analyzed):
+                embedding = result.pop("embedding", None)
+                if self.store is not None:
+                    with tracing.span("result_store.record_analysis"):
+                        result["analysis_id"] = self.store.record_analysis(
+                            digests[i], result, kwargs, phash=phash, source=sources[i],
+                            model_version=result.get("model_version"))
+                self.add(digests[i], phash, result, **kwargs)
+                results[i] = dict(result, dedup_hit=None)
+                if embedding is not None:
+                    results[i]["embedding"] = embedding
+        for i, first in aliases.items():
+            results[i] = dict(results[first], dedup_hit="exact")
+        return results
+
+    # Drop-in for predictions.analyze_image
+    def analyze(self, img_path, digest=None, source=None, embeddings=False, **kwargs):
+        return self.analyze_many([img_path], None if digest is None else [digest],
+                                 None if source is None else [source], embeddings, **kwargs)[0]
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats, entries=len(self._entries))
+        hits = stats["exact_hits"] + stats["near_hits"]
+        stats["hit_rate"] = hits / stats["lookups"] if stats["lookups"] else 0.0
+        return stats
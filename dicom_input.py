@@ -0,0 +1,95 @@
+# DICOM input for the predictor.
+#
+# pydicom is optional and only imported when a DICOM file is actually read.
+# Routing only needs the header (read with stop_before_pixels); pixel data is
+# decoded when a tensor is requested, rescaled to modality units, windowed
+# and resized in floating point straight to the model input size, without
+# an intermediate full-resolution 8-bit image.
+import numpy as np
+from PIL import Image
+
+DICOM_EXTENSIONS = (".dcm", ".dicom")
+
+# BodyPartExamined values (upper-cased) -> Parts category
+BODY_PART_HINTS = {
+    "ELBOW": "Elbow",
+    "HAND": "Hand",
+    "FINGER": "Hand",
+    "SHOULDER": "Shoulder",
+}
+
+
+def _pydicom():
+    try:
+        import pydicom
+    except ImportError as e:
+        raise ImportError("Reading DICOM files requires pydicom (pip install pydicom)") from e
+    return pydicom
+
+
+# Extension check plus the "DICM" magic at offset 128
+def is_dicom(path):
+    if not isinstance(path, str):
+        return False
+    if path.lower().endswith(DICOM_EXTENSIONS):
+        return True
+    try:
+        with open(path, "rb") as f:
+            return f.read(132)[128:] == b"DICM"
+    except OSError:
+        return False
+
+
+def read_header(path):
+    return _pydicom().dcmread(path, stop_before_pixels=True)
+
+
+# Parts category named by BodyPartExamined, or None if absent/unknown
+def bone_hint(path):
+    body_part = str(read_header(path).get("BodyPartExamined", "") or "").strip().upper()
+    return BODY_PART_HINTS.get(body_part)
+
+
+def _first(value):
+    if value is None:
+        return None
+    try:
+        return float(value[0])
+    except TypeError:
+        return float(value)
+
+
+# Pixel data in modality units, windowed to [0, 1] with bright = bone
+def windowed_pixels(path):
+    ds = _pydicom().dcmread(path)
+    pixels = ds.pixel_array
+    if int(ds.get("NumberOfFrames", 1) or 1) > 1:
+        pixels = pixels[0]
+    pixels = pixels.astype(np.float32)
+    if pixels.ndim == 3:
+        # colour secondary captures
+        pixels = pixels.mean(axis=2)
+    pixels = pixels * float(ds.get("RescaleSlope", 1) or 1) + float(ds.get("RescaleIntercept", 0) or 0)
+
+    center, width = _first(ds.get("WindowCenter")), _first(ds.get("WindowWidth"))
+    if center is not None and width is not None and width > 1:
+        low, high = center - width / 2, center + width / 2
+    else:
+        # no usable VOI window: clip the extreme tails instead of min/max
+        low, high = np.percentile(pixels, [0.5, 99.5])
+    pixels = np.clip((pixels - low) / max(high - low, 1e-6), 0.0, 1.0)
+    if ds.get("PhotometricInterpretation") == "MONOCHROME1":
+        pixels = 1.0 - pixels
+    return pixels
+
+
+# (size, size, 3) float array in [0, 255], matching predictions.load_tensor
+def load_dicom_tensor(path, size=224):
+    resized = Image.fromarray(windowed_pixels(path)).resize((size, size), Image.BILINEAR)
+    gray = np.asarray(resized, dtype=np.float32) * 255.0
+    return np.repeat(gray[..., None], 3, axis=2)
+
+
+# 8-bit RGB preview for display only
+def preview_image(path):
+    return Image.fromarray(np.uint8(np.round(windowed_pixels(path) * 255))).convert("RGB")
@@ -0,0 +1,221 @@
+# Nearest-neighbour index of prior cases over pooled ResNet50 embeddings.
+#
+# Each bone's fracture model has its own feature space, so there is one index
+# per bone. Embeddings are reduced to EMBEDDING_DIM with a fixed random
+# projection, L2-normalized and kept in a float16 array. Search is an IVF
+# (inverted file): vectors are bucketed by their nearest k-means centroid and
+# a query only scans the IVF_NPROBE closest buckets, which keeps lookups in
+# the low milliseconds at hundreds of thousands of cases. Small indexes
+# (fewer than IVF_MIN_TRAIN vectors) are searched exhaustively.
+#
+# Indexes are tied to the model version that produced the embeddings; an
+# index saved by other weights is discarded on load.
+import functools
+import json
+import os
+
+import numpy as np
+
+EMBEDDING_INDEX_DIR = os.environ.get("EMBEDDING_INDEX_DIR", "embeddings")
+EMBEDDING_DIM = 256
+IVF_MIN_TRAIN = 4096
+IVF_MAX_LISTS = 1024
+IVF_NPROBE = int(os.environ.get("IVF_NPROBE", "8"))
+_PROJECTION_SEED = 1234
+
+
+# Gaussian random projection (Johnson-Lindenstrauss); deterministic per shape
+# so saved indexes and new queries agree
+@functools.lru_cache(maxsize=4)
+def _projection(in_dim, out_dim):
+    rng = np.random.default_rng(_PROJECTION_SEED)
+    return (rng.standard_normal((in_dim, out_dim)) / np.sqrt(out_dim)).astype(np.float32)
+
+
+def _normalize(x):
+    return x / (np.linalg.norm(x, axis=-1, keepdims=True) + 1e-8)
+
+
+# Spherical k-means on unit vectors; returns (k, dim) unit centroids
+def kmeans(x, k, iters=10, seed=0):
+    rng = np.random.default_rng(seed)
+    centroids = x[rng.choice(len(x), size=k, replace=False)].copy()
+    for _ in range(iters):
+        assign = np.argmax(x @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        empty = np.bincount(assign, minlength=k) == 0
+        # reseed empty clusters with random points
+        sums[empty] = x[rng.choice(len(x), size=int(empty.sum()))]
+        centroids = _normalize(sums)
+    return centroids
+
+
+class EmbeddingIndex:
+    def __init__(self, model_version=None, dim=EMBEDDING_DIM, nprobe=IVF_NPROBE):
+        self.model_version = model_version
+        self.dim = dim
+        self.nprobe = nprobe
+        self._vectors = np.zeros((1024, dim), dtype=np.float16)
+        self._count = 0
+        self.keys = []          # row -> content hash
+        self.meta = []          # row -> dict (label, source, analysis_id, ...)
+        self._rows = {}         # content hash -> row
+        self.centroids = None   # (n_lists, dim) once trained
+        self._lists = None      # list id -> python list of rows
+        self._trained_at = 0
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    def _encode(self, embedding):
+        x = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        if x.shape[0] != self.dim:
+            x = x @ _projection(x.shape[0], self.dim)
+        return _normalize(x)
+
+    def _assign(self, vectors):
+        return np.argmax(vectors.astype(np.float32) @ self.centroids.T, axis=1)
+
+    # Returns False if the key is already indexed
+    def add(self, key, embedding, meta=None):
+        if key in self._rows:
+            return False
+        if self._count == len(self._vectors):
+            grown = np.zeros((2 * len(self._vectors), self.dim), dtype=np.float16)
+            grown[:self._count] = self._vectors[:self._count]
+            self._vectors = grown
+        row = self._count
+        self._vectors[row] = self._encode(embedding)
+        self._count += 1
+        self.keys.append(key)
+        self.meta.append(dict(meta or {}))
+        self._rows[key] = row
+        if self.centroids is not None:
+            self._lists[int(self._assign(self._vectors[row:row + 1])[0])].append(row)
+        # (re)cluster at IVF_MIN_TRAIN and whenever the index has grown 4x
+        if self._count >= max(IVF_MIN_TRAIN, 4 * self._trained_at):
+            self.train()
+        return True
+
+    def train(self, n_lists=None, sample=32):
+        vectors = self._vectors[:self._count]
+        n_lists = n_lists or int(min(IVF_MAX_LISTS, max(16, 4 * np.sqrt(self._count))))
+        rng = np.random.default_rng(0)
+        picked = rng.choice(self._count, size=min(self._count, sample * n_lists), replace=False)
+        self.centroids = kmeans(vectors[picked].astype(np.float32), n_lists)
+        self._lists = [[] for _ in range(n_lists)]
+        for start in range(0, self._count, 65536):
+            for offset, list_id in enumerate(self._assign(vectors[start:start + 65536])):
+                self._lists[int(list_id)].append(start + offset)
+        self._trained_at = self._count
+
+    # k most similar indexed cases as dicts of their meta plus key and
+    # cosine similarity, best first
+    def search(self, embedding, k=5, exclude=None):
+        if self._count == 0:
+            return []
+        query = self._encode(embedding)
+        if self.centroids is None:
+            rows = np.arange(self._count)
+        else:
+            probe = np.argsort(self.centroids @ query)[::-1][:self.nprobe]
+            rows = np.fromiter((r for p in probe for r in self._lists[p]), dtype=np.int64)
+        scores = self._vectors[rows].astype(np.float32) @ query
+        if exclude is not None and exclude in self._rows:
+            scores[rows == self._rows[exclude]] = -np.inf
+        best = np.argpartition(scores, -k)[-k:] if len(rows) > k else np.arange(len(rows))
+        top = best[np.argsort(scores[best])[::-1]]
+        return [dict(self.meta[rows[i]], key=self.keys[rows[i]], similarity=round(float(scores[i]), 4))
+                for i in top if np.isfinite(scores[i])]
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        assign = np.full(self._count, -1, dtype=np.int32)
+        for list_id, rows in enumerate(self._lists or []):
+            assign[rows] = list_id
+        header = {"model_version": self.model_version, "keys": self.keys, "meta": self.meta,
+                  "trained_at": self._trained_at}
+        temp = f"{path}.tmp.npz"
+        np.savez(temp, vectors=self._vectors[:self._count],
+                 centroids=self.centroids if self.centroids is not None else np.zeros((0, self.dim)),
+                 assign=assign, header=np.array(json.dumps(header)))
+        os.replace(temp, path)
+
+    @classmethod
+    def load(cls, path, model_version=None):
+        index = cls(model_version)
+        if not os.path.exists(path):
+            return index
+        with np.load(path) as data:
+            header = json.loads(str(data["header"]))
+            if model_version is not None and header["model_version"] != model_version:
+                return index
+            vectors = data["vectors"]
+            index.dim = vectors.shape[1]
+            index._vectors = np.zeros((max(1024, len(vectors)), index.dim), dtype=np.float16)
+            index._vectors[:len(vectors)] = vectors
+            index._count = len(vectors)
+            index.keys, index.meta = header["keys"], header["meta"]
+            index._rows = {key: row for row, key in enumerate(index.keys)}
+            index._trained_at = header["trained_at"]
+            if len(data["centroids"]):
+                index.centroids = data["centroids"].astype(np.float32)
+                index._lists = [[] for _ in range(len(index.centroids))]
+                for row, list_id in enumerate(data["assign"]):
+                    index._lists[int(list_id)].append(row)
+        index.model_version = header["model_version"]
+        return index
+
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+# One EmbeddingIndex per bone, saved as <directory>/<bone>.npz
+class PriorCases:
+    def __init__(self, directory=EMBEDDING_INDEX_DIR, model_version=None):
+        self.directory = directory
+        self.model_version = model_version
+        self.indexes = {}
+        self._mtimes = {}   # bone -> mtime of the file its index was loaded from
+
+    def _path(self, bone):
+        return os.path.join(self.directory, f"{bone}.npz")
+
+    def index(self, bone):
+        index = self.indexes.get(bone)
+        if index is None:
+            mtime = _mtime(self._path(bone))
+            index = EmbeddingIndex.load(self._path(bone), self.model_version)
+            index.model_version = self.model_version
+            self.indexes[bone], self._mtimes[bone] = index, mtime
+        return index
+
+    # Drop indexes whose file was written since they were loaded (e.g. by
+    # evaluate.py), so the next search reads the new file
+    def refresh(self):
+        for bone in list(self.indexes):
+            if _mtime(self._path(bone)) != self._mtimes.get(bone):
+                self.indexes.pop(bone, None)
+
+    def add(self, bone, key, embedding, meta=None):
+        return self.index(bone).add(key, embedding, dict(meta or {}, bone=bone))
+
+    def search(self, bone, embedding, k=5, exclude=None):
+        return self.index(bone).search(embedding, k, exclude)
+
+    def __contains__(self, item):
+        bone, key = item
+        return key in self.index(bone)
+
+    def save(self):
+        for bone, index in list(self.indexes.items()):
+            index.save(self._path(bone))
+            self._mtimes[bone] = _mtime(self._path(bone))
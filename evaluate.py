@@ -0,0 +1,235 @@
+# Evaluation report for the full cascade on a labelled image tree.
+#
+#   python evaluate.py test.zip --out reports/
+#
+# The tree is laid out as <Bone>/<fractured|normal>/<image> (the layout of
+# test.zip). Per-image predictions are cached in the result store by content
+# hash and model version, so re-running after adding images only scores the
+# new ones. Writes metrics.json, report.md, confusion matrices and a
+# calibration curve to the output directory. Pooled embeddings of the
+# labelled images are added to the prior-case index (embedding_index.py)
+# that the GUI searches for similar studies.
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+import predictions
+from dedup import content_hash
+from embedding_index import EMBEDDING_INDEX_DIR, PriorCases
+from result_store import RESULT_STORE_PATH, ResultStore
+
+# every image gets a fracture score, so low-confidence routing must not skip any
+EVAL_OPTIONS = {"low_confidence_policy": "all"}
+
+
+# (bone, fracture label) from the path components, or None if unlabelled
+def label_from_path(path):
+    parts = os.path.normpath(path).split(os.sep)
+    bones = [p for p in parts if p in predictions.categories_parts]
+    labels = [p for p in parts if p in predictions.categories_fracture]
+    if not bones or not labels:
+        return None
+    return bones[-1], labels[-1]
+
+
+# Cached-or-fresh cascade results for every path, scoring only the misses.
+# With a PriorCases index, images routed to a single fracture model that
+# are not indexed yet are scored too, and their embeddings added with the
+# (bone, label) from `labels`.
+def score_images(paths, store, batch_size=32, cases=None, labels=None):
+    digests = [content_hash(p) for p in paths]
+    cached = store.find_many(digests, EVAL_OPTIONS, predictions.model_version())
+
+    def _todo(digest):
+        if digest not in cached:
+            return True
+        result = cached[digest]
+        return cases is not None and result.get("routing") == "single" and (result["bone"], digest) not in cases
+
+    # one entry per content hash, so in-set duplicates are scored once
+    todo = list({d: (p, d, label) for p, d, label in zip(paths, digests, labels or [None] * len(paths))
+                 if _todo(d)}.values())
+    for offset in range(0, len(todo), batch_size):
+        chunk = todo[offset:offset + batch_size]
+        # the pre-filter is off so every test image is scored by the models
+        results = predictions.analyze_images([p for p, _, _ in chunk], embeddings=cases is not None,
+                                             prefilter_images=False, **EVAL_OPTIONS)
+        for (path, digest, label), result in zip(chunk, results):
+            embedding = result.pop("embedding", None)
+            if digest not in cached:
+                result["analysis_id"] = store.record_analysis(
+                    digest, result, EVAL_OPTIONS, source=path, model_version=result["model_version"])
+                cached[digest] = result
+            if embedding is not None:
+                cases.add(result["bone"], digest, embedding, {
+                    "label": label[1] if label else None,
+                    "source": path,
+                    "analysis_id": cached[digest].get("analysis_id"),
+                })
+    return [cached[d] for d in digests], len(todo)
+
+
+def _binary_metrics(y_true, y_pred):
+    from sklearn.metrics import confusion_matrix, precision_recall_fscore_support
+
+    precision, recall, f1, _ = precision_recall_fscore_support(
+        y_true, y_pred, labels=["fractured"], average=None, zero_division=0)
+    return {
+        "support": len(y_true),
+        "accuracy": float(np.mean(np.asarray(y_true) == np.asarray(y_pred))) if y_true else 0.0,
+        "precision": float(precision[0]),
+        "recall": float(recall[0]),
+        "f1": float(f1[0]),
+        "confusion_matrix": confusion_matrix(
+            y_true, y_pred, labels=predictions.categories_fracture).tolist(),
+    }
+
+
+def compute_metrics(labels, results, n_bins=10):
+    from sklearn.metrics import confusion_matrix
+
+    true_bones = [bone for bone, _ in labels]
+    true_fracture = [label for _, label in labels]
+    pred_bones = [r["bone"] for r in results]
+    pred_fracture = ["fractured" if r["fracture_present"] else "normal" for r in results]
+    probs = np.array([r["severity_percent"] / 100.0 for r in results])
+    y = np.array([label == "fractured" for label in true_fracture], dtype=float)
+
+    metrics = {
+        "model_version": predictions.model_version(),
+        "images": len(labels),
+        "parts": {
+            "accuracy": float(np.mean(np.array(true_bones) == np.array(pred_bones))),
+            "labels": predictions.categories_parts,
+            "confusion_matrix": confusion_matrix(
+                true_bones, pred_bones, labels=predictions.categories_parts).tolist(),
+        },
+        "fracture": {"overall": _binary_metrics(true_fracture, pred_fracture)},
+        "needs_review": int(sum(bool(r.get("needs_review")) for r in results)),
+    }
+    for bone in predictions.categories_parts:
+        idx = [i for i, b in enumerate(true_bones) if b == bone]
+        if idx:
+            metrics["fracture"][bone] = _binary_metrics(
+                [true_fracture[i] for i in idx], [pred_fracture[i] for i in idx])
+
+    # reliability diagram of the fractured probability
+    bins = np.minimum((probs * n_bins).astype(int), n_bins - 1)
+    calibration = []
+    ece = 0.0
+    for b in range(n_bins):
+        mask = bins == b
+        if not mask.any():
+            continue
+        confidence, frequency = float(probs[mask].mean()), float(y[mask].mean())
+        calibration.append({"bin": b, "count": int(mask.sum()),
+                            "mean_predicted": confidence, "fraction_fractured": frequency})
+        ece += mask.mean() * abs(confidence - frequency)
+    metrics["calibration"] = {"bins": calibration, "ece": float(ece)}
+    return metrics
+
+
+def write_plots(metrics, out_dir):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    def _confusion(matrix, labels, title, filename):
+        fig, ax = plt.subplots(figsize=(4, 4))
+        ax.imshow(matrix, cmap="Blues")
+        ax.set_xticks(range(len(labels)))
+        ax.set_xticklabels(labels)
+        ax.set_yticks(range(len(labels)))
+        ax.set_yticklabels(labels)
+        ax.set_xlabel("Predicted")
+        ax.set_ylabel("True")
+        ax.set_title(title)
+        for i, row in enumerate(matrix):
+            for j, value in enumerate(row):
+                ax.text(j, i, value, ha="center", va="center")
+        fig.tight_layout()
+        fig.savefig(os.path.join(out_dir, filename))
+        plt.close(fig)
+
+    _confusion(metrics["parts"]["confusion_matrix"], predictions.categories_parts,
+               "Body part", "confusion_parts.png")
+    for bone in predictions.categories_parts:
+        if bone in metrics["fracture"]:
+            _confusion(metrics["fracture"][bone]["confusion_matrix"], predictions.categories_fracture,
+                       f"{bone} fracture", f"confusion_{bone.lower()}.png")
+
+    bins = metrics["calibration"]["bins"]
+    fig, ax = plt.subplots(figsize=(4, 4))
+    ax.plot([0, 1], [0, 1], "--", color="gray", label="perfect")
+    ax.plot([b["mean_predicted"] for b in bins], [b["fraction_fractured"] for b in bins],
+            "o-", label=f"model (ECE {metrics['calibration']['ece']:.3f})")
+    ax.set_xlabel("Predicted fractured probability")
+    ax.set_ylabel("Observed fraction fractured")
+    ax.legend()
+    fig.tight_layout()
+    fig.savefig(os.path.join(out_dir, "calibration.png"))
+    plt.close(fig)
+
+
+def write_report(metrics, out_dir):
+    with open(os.path.join(out_dir, "metrics.json"), "w") as f:
+        json.dump(metrics, f, indent=2)
+
+    lines = [
+        f"# Evaluation report (model {metrics['model_version']})",
+        "",
+        f"- Images: {metrics['images']}",
+        f"- Body part accuracy: {metrics['parts']['accuracy']:.3f}",
+        f"- Flagged for review: {metrics['needs_review']}",
+        f"- Calibration ECE: {metrics['calibration']['ece']:.3f}",
+        "",
+        "| Bone | Support | Accuracy | Precision | Recall | F1 |",
+        "|------|---------|----------|-----------|--------|----|",
+    ]
+    for name, m in metrics["fracture"].items():
+        lines.append(f"| {name} | {m['support']} | {m['accuracy']:.3f} | {m['precision']:.3f} "
+                     f"| {m['recall']:.3f} | {m['f1']:.3f} |")
+    with open(os.path.join(out_dir, "report.md"), "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate the cascade on a labelled X-ray tree")
+    parser.add_argument("images", help="directory or .zip laid out as <Bone>/<fractured|normal>/...")
+    parser.add_argument("--out", default="reports", help="output directory")
+    parser.add_argument("--store", default=RESULT_STORE_PATH, help="SQLite result store used as the cache")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--embeddings", default=EMBEDDING_INDEX_DIR,
+                        help="prior-case embedding index directory to populate")
+    parser.add_argument("--no-embeddings", action="store_true", help="don't update the embedding index")
+    args = parser.parse_args()
+
+    labelled = [(p, label_from_path(p)) for p in predictions.collect_images(args.images)]
+    labelled = [(p, label) for p, label in labelled if label is not None]
+    if not labelled:
+        raise SystemExit(f"No labelled images found in {args.images}")
+
+    start = time.perf_counter()
+    store = ResultStore(args.store)
+    cases = None if args.no_embeddings else PriorCases(args.embeddings, predictions.model_version())
+    try:
+        results, scored = score_images([p for p, _ in labelled], store, args.batch_size,
+                                       cases, [label for _, label in labelled])
+    finally:
+        store.close()
+    if cases is not None:
+        cases.save()
+
+    os.makedirs(args.out, exist_ok=True)
+    metrics = compute_metrics([label for _, label in labelled], results)
+    write_report(metrics, args.out)
+    write_plots(metrics, args.out)
+    print(f"{len(labelled)} images ({scored} newly scored, {len(labelled) - scored} cached) "
+          f"in {time.perf_counter() - start:.1f}s -> {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,324 @@
+# Inbox ingestion service: analyzes X-rays dropped into a shared folder.
+#
+#   python inbox_watcher.py inbox/ --out outbox/ --batch-size 32 --workers 2
+#
+# The inbox is polled; a file is picked up once its size and mtime have been
+# stable for --settle seconds, so files still being copied are not read.
+# Ready files are queued and a fixed number of workers drain the queue in
+# micro-batches through DedupIndex.analyze_many backed by the result store.
+# Content that was analyzed before (same sha256, options and model version)
+# is answered from the store, so restarts and re-dropped files never re-run
+# inference. Each result is also written to <out>/<sha256>.json, and the
+# file is then moved to <inbox>/.done/ (--processed delete/keep to change
+# that), so polls only ever look at new files. Files with the same content
+# under different names are analyzed once, also across concurrent batches.
+#
+# A batch that fails is retried file by file, so one unreadable file does
+# not sink the others. Failed files are handed back to the scanner and
+# picked up again; after --max-attempts failures a file is moved to
+# <inbox>/.failed/ (hidden, so it is not watched).
+import argparse
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+import dicom_input
+import predictions
+from dedup import DedupIndex, content_hash
+from result_store import RESULT_STORE_PATH, ResultStore
+
+logger = logging.getLogger(__name__)
+
+
+class InboxWatcher:
+    def __init__(self, inbox, index, out_dir=None, options=None, settle=2.0, interval=1.0,
+                 batch_size=32, batch_window=0.5, workers=2, max_queue=10000, max_attempts=3,
+                 processed="move"):
+        self.inbox = os.path.abspath(inbox)
+        self.index = index
+        self.out_dir = os.path.abspath(out_dir) if out_dir else None
+        self.options = options or {}
+        self.settle = settle
+        self.interval = interval
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.processed = processed   # "move" to <inbox>/.done/, "delete" or "keep"
+        # a full queue blocks the scanner, which is the backpressure on bursts
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._pending = {}   # path -> ((size, mtime), time the signature was first seen)
+        self._queued = {}    # path -> signature it was queued with
+        self._skipped = {}   # path -> signature of a settled file that is not an image
+        self._attempts = {}  # path -> failed analyses so far
+        self._failed = queue.Queue()   # paths handed back by the workers
+        self._inflight_lock = threading.Lock()
+        self._inflight = {}  # digest -> Event set once the worker analyzing it is done
+        self._stats_lock = threading.Lock()
+        self._stats = {"files": 0, "analyzed": 0, "reused": 0, "failed": 0, "quarantined": 0, "batches": 0}
+        self._threads = []
+
+    def _walk(self):
+        for root, dirs, files in os.walk(self.inbox):
+            dirs[:] = [d for d in dirs if not d.startswith(".")
+                       and os.path.join(root, d) != self.out_dir]
+            for name in files:
+                if not name.startswith("."):
+                    yield os.path.join(root, name)
+
+    # Extensionless files are probed for the DICM magic; scan() does this
+    # once per settled file version, never on every poll
+    @staticmethod
+    def _is_image(path):
+        return path.lower().endswith(predictions.IMAGE_EXTENSIONS) or dicom_input.is_dicom(path)
+
+    def _quarantine(self, path):
+        target_dir = os.path.join(self.inbox, ".failed")
+        os.makedirs(target_dir, exist_ok=True)
+        try:
+            os.replace(path, os.path.join(target_dir, os.path.basename(path)))
+        except OSError as e:
+            logger.warning("Could not quarantine %s: %s", path, e)
+            return
+        logger.warning("Quarantined %s after %d failed attempts", path, self.max_attempts)
+        with self._stats_lock:
+            self._stats["quarantined"] += 1
+
+    # Forget files the workers failed on, so they are picked up again, or
+    # quarantine them once they have failed max_attempts times
+    def _requeue_failed(self):
+        while True:
+            try:
+                path = self._failed.get_nowait()
+            except queue.Empty:
+                return
+            self._queued.pop(path, None)
+            self._attempts[path] = self._attempts.get(path, 0) + 1
+            if self._attempts[path] >= self.max_attempts:
+                del self._attempts[path]
+                self._quarantine(path)
+
+    # Image paths whose size and mtime have been unchanged for `settle`
+    # seconds and that were not queued before with the same signature
+    def scan(self):
+        self._requeue_failed()
+        now = time.monotonic()
+        ready = []
+        present = set()
+        for path in self._walk():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            present.add(path)
+            signature = (stat.st_size, stat.st_mtime_ns)
+            if self._queued.get(path) == signature or self._skipped.get(path) == signature:
+                continue
+            seen = self._pending.get(path)
+            if seen is None or seen[0] != signature:
+                self._pending[path] = (signature, now)
+            elif now - seen[1] >= self.settle and stat.st_size > 0:
+                del self._pending[path]
+                if self._is_image(path):
+                    self._queued[path] = signature
+                    ready.append(path)
+                else:
+                    self._skipped[path] = signature
+        for tracked in (self._pending, self._queued, self._skipped, self._attempts):
+            for path in [p for p in tracked if p not in present]:
+                del tracked[path]
+        return ready
+
+    def _take_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.batch_window
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _worker(self):
+        while True:
+            batch = self._take_batch()
+            try:
+                self._process(batch)
+            except Exception:
+                logger.exception("Batch of %d files failed", len(batch))
+                for path in batch:
+                    self._fail(path)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _write_output(self, path, digest, result):
+        target = os.path.join(self.out_dir, f"{digest}.json")
+        temp = f"{target}.tmp{threading.get_ident()}"
+        with open(temp, "w") as f:
+            json.dump(dict(result, source=path, content_hash=digest), f)
+        os.replace(temp, target)
+
+    def _fail(self, path):
+        with self._stats_lock:
+            self._stats["failed"] += 1
+        self._failed.put(path)
+
+    def _finish(self, path):
+        try:
+            if self.processed == "move":
+                target = os.path.join(self.inbox, ".done", os.path.relpath(path, self.inbox))
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(path, target)
+            elif self.processed == "delete":
+                os.remove(path)
+        except OSError as e:
+            logger.warning("Could not clear %s from the inbox: %s", path, e)
+
+    # (digest, result) pairs for the whole batch, or, if that raises, digest
+    # by digest with the ones that still fail left out. by_digest maps each
+    # digest to the paths with that content; the first one is analyzed.
+    def _analyze(self, digests, by_digest):
+        if not digests:
+            return []
+        try:
+            results = self.index.analyze_many([by_digest[d][0] for d in digests], digests=digests, **self.options)
+            return list(zip(digests, results))
+        except Exception as e:
+            if len(digests) == 1:
+                logger.warning("Failed to analyze %s: %s", by_digest[digests[0]][0], e)
+                for path in by_digest[digests[0]]:
+                    self._fail(path)
+                return []
+            logger.warning("Batch of %d files failed (%s); retrying them one by one", len(digests), e)
+        return [pair for digest in digests for pair in self._analyze([digest], by_digest)]
+
+    def _process(self, batch):
+        by_digest = {}
+        for path in batch:
+            try:
+                by_digest.setdefault(content_hash(path), []).append(path)
+            except OSError as e:
+                logger.warning("Skipping %s: %s", path, e)
+                self._fail(path)
+        if not by_digest:
+            return
+
+        # Content another worker is analyzing right now is left until it is
+        # done and then comes from the store, instead of running twice
+        start = time.perf_counter()
+        with self._inflight_lock:
+            claimed = [d for d in by_digest if d not in self._inflight]
+            waiting = [(d, self._inflight[d]) for d in by_digest if d in self._inflight]
+            for digest in claimed:
+                self._inflight[digest] = threading.Event()
+        try:
+            analyzed = self._analyze(claimed, by_digest)
+        finally:
+            with self._inflight_lock:
+                for digest in claimed:
+                    self._inflight.pop(digest).set()
+        for _, event in waiting:
+            event.wait()
+        analyzed += self._analyze([d for d, _ in waiting], by_digest)
+        if not analyzed:
+            return
+
+        files = reused = 0
+        for digest, result in analyzed:
+            if self.out_dir:
+                self._write_output(by_digest[digest][0], digest, result)
+            for path in by_digest[digest]:
+                self._finish(path)
+            files += len(by_digest[digest])
+            reused += len(by_digest[digest]) - (0 if result.get("dedup_hit") else 1)
+        with self._stats_lock:
+            self._stats["files"] += files
+            self._stats["reused"] += reused
+            self._stats["analyzed"] += files - reused
+            self._stats["batches"] += 1
+        logger.info("Batch of %d files in %.2fs (%d reused)", files, time.perf_counter() - start, reused)
+
+    def start_workers(self):
+        if self.out_dir:
+            os.makedirs(self.out_dir, exist_ok=True)
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._worker, name=f"inbox-worker-{len(self._threads)}",
+                                      daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    # Poll forever, or with once=True until every file present at start
+    # (and anything dropped meanwhile) has been processed or quarantined
+    def run(self, once=False):
+        self.start_workers()
+        while True:
+            for path in self.scan():
+                self._queue.put(path)
+            if once and not self._pending:
+                self._queue.join()
+                if self._failed.empty():
+                    break
+                continue
+            time.sleep(self.interval)
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["queued"] = self._queue.qsize()
+        stats["settling"] = len(self._pending)
+        return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Watch an inbox directory and analyze new X-rays")
+    parser.add_argument("inbox", help="directory to watch (searched recursively)")
+    parser.add_argument("--out", help="write <sha256>.json results here")
+    parser.add_argument("--store", default=RESULT_STORE_PATH, help="SQLite result store")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--batch-window", type=float, default=0.5,
+                        help="seconds a worker waits to fill a batch")
+    parser.add_argument("--workers", type=int, default=2, help="batches analyzed concurrently")
+    parser.add_argument("--settle", type=float, default=2.0,
+                        help="seconds a file must stay unchanged before it is read")
+    parser.add_argument("--interval", type=float, default=1.0, help="polling interval in seconds")
+    parser.add_argument("--tta", type=int, default=0, help="test-time augmentation views")
+    parser.add_argument("--policy", choices=["all", "review"], help="low-confidence routing policy")
+    parser.add_argument("--max-attempts", type=int, default=3,
+                        help="failed analyses before a file is moved to <inbox>/.failed/")
+    parser.add_argument("--processed", choices=["move", "delete", "keep"], default="move",
+                        help="what to do with analyzed files: move them to <inbox>/.done/ (default), "
+                             "delete them, or keep them in place")
+    parser.add_argument("--once", action="store_true", help="process the current inbox and exit")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    options = {}
+    if args.tta:
+        options["tta"] = args.tta
+    if args.policy:
+        options["low_confidence_policy"] = args.policy
+
+    store = ResultStore(args.store)
+    watcher = InboxWatcher(args.inbox, DedupIndex(store=store), out_dir=args.out, options=options,
+                           settle=args.settle, interval=args.interval, batch_size=args.batch_size,
+                           batch_window=args.batch_window, workers=args.workers,
+                           max_attempts=args.max_attempts, processed=args.processed)
+    logger.info("Watching %s", watcher.inbox)
+    try:
+        watcher.run(once=args.once)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logger.info("Stopped: %s", watcher.stats())
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
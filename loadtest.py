@@ -0,0 +1,342 @@
+# Concurrent-session load test for the app's analysis and chat paths.
+#
+#   python loadtest.py test.zip --sessions 1,4,8,16 --duration 60 --slo-ms 5000
+#   ASSISTANT_BACKEND=stub python loadtest.py test.zip --sessions 8
+#
+# Each simulated session does what a mainGUI.py user does: upload an image
+# from the set (hash the bytes, save the temp file), click Analyze (the
+# deduplicated cascade behind the analysis admission gate, with heatmap and
+# embedding), then ask --chat-per-study questions, a mix of topic keywords
+# (answered from assistant.py) and free text (response cache, then the
+# assistant worker behind the LLM admission gate), with --think-time pauses
+# in between. The shared objects are the ones mainGUI.py keeps in
+# st.cache_resource, so contention is the same as in one app instance.
+#
+# Sessions are threads in this process, which plays the app server.
+# --sessions takes a comma-separated list of steps run back to back; for
+# each step the report has throughput, p50/p95/p99 latency, shed (admission
+# rejected) and error rates per operation, and the RSS of this process plus
+# the assistant worker sampled over time. With ASSISTANT_BACKEND=stub the
+# worker answers with canned text after ASSISTANT_STUB_LATENCY seconds, so
+# the harness runs offline without torch or the Gemma weights.
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+
+import assistant
+import predictions
+import tracing
+from admission import Overloaded, analysis_admission, llm_admission
+from assistant_worker import ASSISTANT_BACKEND, AssistantClient
+from dedup import DedupIndex, content_hash
+from result_store import ResultStore, result_label
+
+KEYWORD_PROMPTS = [
+    "What should I eat to heal faster?",
+    "Which exercises are safe now?",
+    "What is the recovery timeline?",
+    "What precautions should I take?",
+    "What medicine helps with the pain?",
+    "Give me a full overview",
+]
+# no section keywords, so these need the LLM (or the response cache)
+FREE_TEXT_PROMPTS = [
+    "Is this serious?",
+    "Can I still type on a keyboard?",
+    "Should I see a doctor today?",
+    "Will I be able to play the piano again?",
+    "Is the swelling normal?",
+    "Can I fly next week with this?",
+    "Why does it hurt more at night?",
+    "Do I need a cast?",
+]
+
+
+# Resident set size in MB from /proc (Linux), or None
+def rss_mb(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.events = []    # (operation, outcome, seconds, error message or None)
+
+    def record(self, operation, outcome, seconds, detail=None):
+        with self._lock:
+            self.events.append((operation, outcome, seconds, detail))
+
+    # Run fn() as one timed operation; outcome is "ok", "shed" or "error"
+    def timed(self, operation, fn):
+        start = time.perf_counter()
+        try:
+            detail = fn()
+        except Overloaded:
+            self.record(operation, "shed", time.perf_counter() - start)
+            return None
+        except Exception as e:
+            self.record(operation, "error", time.perf_counter() - start, f"{type(e).__name__}: {e}")
+            return None
+        self.record(operation, "ok", time.perf_counter() - start)
+        return detail
+
+
+class App:
+    def __init__(self, store_path, reuse):
+        self.store = ResultStore(store_path)
+        self.analysis_gate = analysis_admission()
+        self.llm_gate = llm_admission()
+        # max_entries=0 keeps the index empty, so without --reuse every
+        # upload (given a unique digest) runs the cascade
+        self.dedup = DedupIndex(store=self.store, admission=self.analysis_gate,
+                                **({} if reuse else {"max_entries": 0}))
+        self.cache = assistant.ResponseCache()
+        self.client = AssistantClient()
+        self.reuse = reuse
+        self._uploads = itertools.count()
+
+    def close(self):
+        self.client.stop()
+        self.store.close()
+
+
+def run_session(app, recorder, images, upload_dir, args, stop_at, rng):
+    while time.monotonic() < stop_at:
+        path = rng.choice(images)
+
+        def upload():
+            with open(path, "rb") as f:
+                data = f.read()
+            digest = content_hash(data)
+            if not app.reuse:
+                digest = hashlib.sha256(f"{digest}:{next(app._uploads)}".encode()).hexdigest()
+            temp_path = os.path.join(upload_dir, f"{digest}{os.path.splitext(path)[1]}")
+            with open(temp_path, "wb") as f:
+                f.write(data)
+            return temp_path, digest
+
+        uploaded = recorder.timed("upload", upload)
+        if uploaded is None:
+            continue
+        temp_path, digest = uploaded
+
+        # (bone, label) to chat about, or None when the result needs review
+        def analyze():
+            try:
+                result = app.dedup.analyze_many(
+                    [temp_path], digests=[digest], tta=args.tta, heatmap=True, embeddings=True)[0]
+            finally:
+                os.remove(temp_path)
+            label = result_label(result)
+            if label == "review":
+                return None
+            return result["bone"], label
+
+        trace_id = tracing.new_correlation_id()
+        with tracing.span("analyze", correlation_id=trace_id):
+            analyzed = recorder.timed("analyze", analyze)
+        if analyzed is None:
+            time.sleep(args.think_time * rng.random())
+            continue
+
+        bone, prediction = analyzed
+        # seeded like the GUI, which greets every analysis in the chat
+        history = [{"role": "assistant", "content": assistant.analysis_message(bone, prediction)}]
+        for _ in range(args.chat_per_study):
+            if time.monotonic() >= stop_at:
+                break
+            time.sleep(args.think_time * rng.random())
+            free_text = rng.random() < args.free_text_ratio
+            prompt = rng.choice(FREE_TEXT_PROMPTS if free_text else KEYWORD_PROMPTS)
+            history.append({"role": "user", "content": prompt})
+
+            def chat():
+                answer = assistant.quick_answer(prompt, bone, prediction, app.cache, history=history[:-1])
+                if answer is None:
+                    answer = assistant.llm_answer(prompt, bone, prediction, app.client, app.cache,
+                                                  app.llm_gate, history=history[:-1])
+                return answer
+
+            with tracing.span("chat", correlation_id=trace_id):
+                answer = recorder.timed("chat_free_text" if free_text else "chat_keyword", chat)
+            if answer is not None:
+                history.append({"role": "assistant", "content": answer})
+        time.sleep(args.think_time * rng.random())
+
+
+def sample_memory(app, samples, stop, interval, started):
+    while not stop.wait(interval):
+        worker = rss_mb(app.client.pid) if app.client.pid else None
+        samples.append((time.monotonic() - started, rss_mb(os.getpid()), worker))
+
+
+def _percentile_ms(timings, q):
+    return float(np.percentile(timings, q)) * 1000 if timings else 0.0
+
+
+def _print_table(header, rows):
+    widths = [max(len(str(v)) for v in col) for col in zip(header, *rows)]
+    for row in [header] + rows:
+        print("  ".join(str(v).rjust(w) for v, w in zip(row, widths)))
+
+
+def summarize(events, elapsed):
+    by_operation = defaultdict(list)
+    for operation, outcome, seconds, _ in events:
+        by_operation[operation].append((outcome, seconds))
+    summary = {}
+    for operation in ("upload", "analyze", "chat_keyword", "chat_free_text"):
+        entries = by_operation.get(operation, [])
+        ok = [s for o, s in entries if o == "ok"]
+        n = len(entries)
+        summary[operation] = {
+            "requests": n,
+            "ok": len(ok),
+            "throughput_per_sec": len(ok) / elapsed if elapsed else 0.0,
+            "p50_ms": _percentile_ms(ok, 50),
+            "p95_ms": _percentile_ms(ok, 95),
+            "p99_ms": _percentile_ms(ok, 99),
+            "shed_rate": sum(1 for o, _ in entries if o == "shed") / n if n else 0.0,
+            "error_rate": sum(1 for o, _ in entries if o == "error") / n if n else 0.0,
+        }
+    return summary
+
+
+def run_step(app, images, args, sessions, upload_dir):
+    recorder = Recorder()
+    samples = []
+    stop = threading.Event()
+    started = time.monotonic()
+    sampler = threading.Thread(target=sample_memory, args=(app, samples, stop, args.rss_interval, started),
+                               daemon=True)
+    sampler.start()
+
+    stop_at = started + args.ramp + args.duration
+    threads = []
+    for i in range(sessions):
+        # sessions arrive evenly over the ramp-up
+        if args.ramp and sessions > 1:
+            time.sleep(args.ramp / sessions)
+        rng = random.Random(args.seed * 100003 + sessions * 1009 + i)
+        thread = threading.Thread(target=run_session, name=f"session-{i}",
+                                  args=(app, recorder, images, upload_dir, args, stop_at, rng), daemon=True)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    stop.set()
+    sampler.join()
+
+    errors = defaultdict(int)
+    for _, outcome, _, detail in recorder.events:
+        if outcome == "error":
+            errors[detail] += 1
+    return {
+        "sessions": sessions,
+        "elapsed": elapsed,
+        "operations": summarize(recorder.events, elapsed),
+        "errors": dict(errors),
+        "rss_mb": [{"t": round(t, 1), "app": app_rss, "assistant": worker_rss}
+                   for t, app_rss, worker_rss in samples],
+        "dedup": app.dedup.stats(),
+        "analysis_gate": app.analysis_gate.stats(),
+        "llm_gate": app.llm_gate.stats(),
+        "response_cache": app.cache.stats(),
+    }
+
+
+def print_step(step, slo_ms):
+    print(f"\n=== {step['sessions']} sessions, {step['elapsed']:.0f}s ===")
+    rows = []
+    for operation, s in step["operations"].items():
+        if s["requests"]:
+            rows.append([operation, s["requests"], f"{s['throughput_per_sec']:.2f}", f"{s['p50_ms']:.0f}",
+                         f"{s['p95_ms']:.0f}", f"{s['p99_ms']:.0f}", f"{s['shed_rate']:.1%}",
+                         f"{s['error_rate']:.1%}"])
+    _print_table(["operation", "n", "ok/s", "p50 ms", "p95 ms", "p99 ms", "shed", "errors"], rows)
+    for detail, count in sorted(step["errors"].items(), key=lambda item: -item[1])[:5]:
+        print(f"  {count} x {detail}")
+
+    samples = step["rss_mb"]
+    if samples:
+        # about ten evenly spaced samples plus the peaks
+        every = max(1, len(samples) // 10)
+        print("RSS (MB): " + ", ".join(
+            f"{s['t']:.0f}s {s['app'] or 0:.0f}" + (f"+{s['assistant']:.0f}" if s["assistant"] else "")
+            for s in samples[::every]))
+        print(f"  peak app {max(s['app'] or 0 for s in samples):.0f} MB, "
+              f"peak assistant {max(s['assistant'] or 0 for s in samples):.0f} MB")
+    print(f"cumulative: dedup hit rate {step['dedup']['hit_rate']:.1%}, "
+          f"answer cache hit rate {step['response_cache']['hit_rate']:.1%}, "
+          f"analysis queue wait p95 {step['analysis_gate']['queue_wait_p95'] * 1000:.0f} ms")
+    if slo_ms:
+        p95 = step["operations"]["analyze"]["p95_ms"]
+        print(f"analyze p95 {p95:.0f} ms: {'within' if p95 <= slo_ms else 'OVER'} the {slo_ms:.0f} ms SLO")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate concurrent app sessions (analyze + chat)")
+    parser.add_argument("images", help="directory or .zip of X-ray images (e.g. test.zip)")
+    parser.add_argument("--sessions", default="4", help="comma-separated concurrent session counts, run in turn")
+    parser.add_argument("--duration", type=float, default=60.0, help="seconds per step after ramp-up")
+    parser.add_argument("--ramp", type=float, default=10.0, help="seconds over which sessions start")
+    parser.add_argument("--think-time", type=float, default=2.0, help="max random pause between actions")
+    parser.add_argument("--chat-per-study", type=int, default=3, help="chat messages after each analysis")
+    parser.add_argument("--free-text-ratio", type=float, default=0.5,
+                        help="share of chat messages that need the LLM")
+    parser.add_argument("--tta", type=int, default=0, help="test-time augmentation views per analysis")
+    parser.add_argument("--reuse", action="store_true",
+                        help="let repeated images hit the dedup index (default: every upload runs the cascade)")
+    parser.add_argument("--slo-ms", type=float, help="analyze p95 target; exit non-zero if a step misses it")
+    parser.add_argument("--rss-interval", type=float, default=1.0, help="memory sampling period in seconds")
+    parser.add_argument("--store", help="SQLite result store (default: a temporary one)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the full report here")
+    args = parser.parse_args()
+
+    images = predictions.collect_images(args.images)
+    if not images:
+        raise SystemExit(f"No images found in {args.images}")
+    work_dir = tempfile.mkdtemp(prefix="bone_loadtest_")
+    app = App(args.store or os.path.join(work_dir, "results.sqlite3"), args.reuse)
+    print(f"{len(images)} images, assistant backend: {ASSISTANT_BACKEND}, model {predictions.model_version()}")
+
+    report = []
+    try:
+        # load the models once so the first step isn't billed for it
+        predictions.current_models()
+        for sessions in [int(n) for n in args.sessions.split(",")]:
+            step = run_step(app, images, args, sessions, work_dir)
+            print_step(step, args.slo_ms)
+            report.append(step)
+    finally:
+        app.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.slo_ms and any(s["operations"]["analyze"]["p95_ms"] > args.slo_ms for s in report):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
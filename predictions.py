@@ -1,105 +1,800 @@
+import hashlib
+import json
+import logging
 import os
+import platform
+import tempfile
+import threading
+import time
+import zipfile
+from collections import Counter
 import numpy as np
-import tensorflow as tf
-from keras.preprocessing import image
-from keras.optimizers import Adam
+from PIL import Image
+import dicom_input
+import prefilter
+import tracing
 
 # optional: disable oneDNN warnings
 os.environ["TF_ENABLE_ONEDNN_OPTS"] = "0"
 
-# Load models WITHOUT loading old optimizer state
-model_elbow_frac = tf.keras.models.load_model("weights/ResNet50_Elbow_frac.h5", compile=False)
-model_hand_frac = tf.keras.models.load_model("weights/ResNet50_Hand_frac.h5", compile=False)
-model_shoulder_frac = tf.keras.models.load_model("weights/ResNet50_Shoulder_frac.h5", compile=False)
-model_parts = tf.keras.models.load_model("weights/ResNet50_BodyParts.h5", compile=False)
+logger = logging.getLogger(__name__)
 
-# (Optional) Recompile if you plan to train further, not needed for inference
-for m in [model_elbow_frac, model_hand_frac, model_shoulder_frac, model_parts]:
-    m.compile(optimizer=Adam(learning_rate=0.001), 
-              loss="categorical_crossentropy", 
-              metrics=["accuracy"])
+
+# Per-node-type inference settings written by autotune.py, keyed by host_key()
+AUTOTUNE_PATH = os.environ.get("AUTOTUNE_PATH", "autotune.json")
+# overrides host_key(), e.g. an instance type name shared by a node pool
+AUTOTUNE_HOST_KEY = os.environ.get("AUTOTUNE_HOST_KEY", "")
+DEFAULT_INFERENCE_CONFIG = {"batch_size": 32, "intra_op_threads": 0, "inter_op_threads": 0}
+# environment overrides for each setting
+_INFERENCE_ENV = {
+    "batch_size": "INFERENCE_BATCH_SIZE",
+    "intra_op_threads": "TF_INTRA_OP_THREADS",
+    "inter_op_threads": "TF_INTER_OP_THREADS",
+}
+
+
+def _cpu_model():
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    return " ".join(line.split(":", 1)[1].split())
+    except OSError:
+        pass
+    return platform.processor() or platform.machine()
+
+
+# Hardware type (CPU model and core count) rather than the hostname, so a
+# freshly autoscaled node picks up the settings tuned on another node of
+# the same type
+def host_key():
+    if AUTOTUNE_HOST_KEY:
+        return AUTOTUNE_HOST_KEY
+    return f"{_cpu_model()}-{os.cpu_count()}cpu"
+
+
+# Tuned settings for this node type from the autotune file, or {}
+def tuned_config(path=None):
+    try:
+        with open(path or AUTOTUNE_PATH) as f:
+            return json.load(f).get(host_key(), {})
+    except (OSError, ValueError):
+        return {}
+
+
+_inference_config = None
+
+
+# Batch size and TF thread counts: defaults, then this host's tuned values,
+# then environment overrides (0 threads = TensorFlow's default)
+def inference_config():
+    global _inference_config
+    if _inference_config is None:
+        config = dict(DEFAULT_INFERENCE_CONFIG)
+        config.update({k: int(v) for k, v in tuned_config().items() if k in config})
+        for key, env in _INFERENCE_ENV.items():
+            if os.environ.get(env):
+                config[key] = int(os.environ[env])
+        _inference_config = config
+    return _inference_config
+
+
+_tf_lock = threading.Lock()
+_tf_configured = False
+
+
+# TensorFlow/Keras are only imported by the code paths that run a model, so
+# importing this module (for the category lists, collect_images, the
+# manifest helpers, ...) stays cheap. Models load on first use. Thread
+# counts can only be set before TF initializes, so they are applied here.
+def _tensorflow():
+    global _tf_configured
+    import tensorflow as tf
+    if not _tf_configured:
+        with _tf_lock:
+            if not _tf_configured:
+                config = inference_config()
+                try:
+                    if config["intra_op_threads"]:
+                        tf.config.threading.set_intra_op_parallelism_threads(config["intra_op_threads"])
+                    if config["inter_op_threads"]:
+                        tf.config.threading.set_inter_op_parallelism_threads(config["inter_op_threads"])
+                except RuntimeError:
+                    logger.warning("TensorFlow was initialized before the thread settings could be applied")
+                _tf_configured = True
+    return tf
+
+# Default weights, used when there is no manifest
+MODEL_PATHS = {
+    "Elbow": "weights/ResNet50_Elbow_frac.h5",
+    "Hand": "weights/ResNet50_Hand_frac.h5",
+    "Shoulder": "weights/ResNet50_Shoulder_frac.h5",
+    "Parts": "weights/ResNet50_BodyParts.h5",
+}
+
+# Versioned model manifest, e.g.
+#   {"version": "2025-11-02", "models": {"Parts": "ResNet50_BodyParts.h5", "Elbow": ..., ...}}
+# with paths relative to the manifest. Shipping new weights = writing new
+# files plus a manifest with a new version; running processes pick it up
+# through reload_models()/watch_manifest() without a restart.
+MODEL_MANIFEST = os.environ.get("MODEL_MANIFEST", "weights/manifest.json")
+
+
+# Short fingerprint of the weight files, used as the version without a manifest
+def _weights_version(paths):
+    digest = hashlib.sha1()
+    for name in sorted(paths):
+        stat = os.stat(paths[name])
+        digest.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+    return digest.hexdigest()[:12]
+
+
+# (version, {model name: weights path}) from the manifest, or the defaults
+def read_manifest(manifest_path=None):
+    manifest_path = manifest_path or MODEL_MANIFEST
+    if not os.path.exists(manifest_path):
+        return _weights_version(MODEL_PATHS), dict(MODEL_PATHS)
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    base = os.path.dirname(manifest_path)
+    paths = {name: os.path.join(base, path) for name, path in manifest["models"].items()}
+    missing = set(MODEL_PATHS) - set(paths)
+    if missing:
+        raise ValueError(f"Manifest {manifest_path} is missing models: {sorted(missing)}")
+    return str(manifest["version"]), paths
+
+
+# One loaded set of weights. Requests take the active set once and use it
+# throughout, so a hot swap never mixes weights within a request, and the
+# derived graphs (combined fracture model, Grad-CAM models) live and die
+# with the weights they were built from.
+class ModelSet:
+    def __init__(self, version, paths):
+        self.version = version
+        self.paths = dict(paths)
+        tf = _tensorflow()
+        from keras.optimizers import Adam
+        # Load models WITHOUT loading old optimizer state
+        self.models = {name: tf.keras.models.load_model(path, compile=False)
+                       for name, path in self.paths.items()}
+        # (Optional) Recompile if you plan to train further, not needed for inference
+        for m in self.models.values():
+            m.compile(optimizer=Adam(learning_rate=0.001),
+                      loss="categorical_crossentropy",
+                      metrics=["accuracy"])
+        self._lock = threading.Lock()
+        self._all_fracture_model = None
+        self._grad_models = {}
+
+    def get(self, model="Parts"):
+        if model not in self.models:
+            raise ValueError(f"Unknown model: {model}")
+        return self.models[model]
+
+    # Single graph feeding the same batch through all three fracture models,
+    # so uncertain images cost one predict call instead of three
+    def all_fracture_model(self):
+        with self._lock:
+            if self._all_fracture_model is None:
+                tf = _tensorflow()
+                inputs = tf.keras.Input(shape=(224, 224, 3))
+                outputs = [self.models[bone](inputs) for bone in categories_parts]
+                self._all_fracture_model = tf.keras.Model(inputs, outputs)
+            return self._all_fracture_model
+
+    # Same weights as the fracture model, but also exposing the last conv feature map
+    def grad_model(self, model):
+        with self._lock:
+            if model not in self._grad_models:
+                tf = _tensorflow()
+                chosen_model = self.get(model)
+                conv_layer = _last_conv_layer(chosen_model)
+                self._grad_models[model] = tf.keras.Model(
+                    chosen_model.inputs, [conv_layer.output, chosen_model.output])
+            return self._grad_models[model]
+
+    # Run every graph once so the first real request after a swap doesn't pay tracing
+    def warm_up(self):
+        x = np.zeros((1, 224, 224, 3), dtype="float32")
+        for m in self.models.values():
+            m.predict(x, verbose=0)
+        self.all_fracture_model().predict(x, verbose=0)
+        for bone in categories_parts:
+            self.grad_model(bone)(x, training=False)
+
+
+_reload_lock = threading.Lock()
+_active_models = None
+
+
+# The active ModelSet, loading the manifest's weights on first use
+def current_models():
+    global _active_models
+    if _active_models is None:
+        with _reload_lock:
+            if _active_models is None:
+                _active_models = ModelSet(*read_manifest())
+    return _active_models
+
+
+# Version of the active weights; before they are loaded, the version that
+# would be loaded (so dedup/store lookups don't force a model load)
+def model_version():
+    models = _active_models
+    return models.version if models is not None else read_manifest()[0]
+
+
+# Load the manifest's weights, warm them up and swap them in atomically.
+# Requests already running keep the set they started with. Returns True if
+# a new version was installed.
+def reload_models(manifest_path=None, force=False):
+    global _active_models
+    with _reload_lock:
+        version, paths = read_manifest(manifest_path)
+        previous = _active_models.version if _active_models is not None else None
+        # nothing loaded yet: the first current_models() call reads the manifest anyway
+        if not force and (previous is None or version == previous):
+            return False
+        new_models = ModelSet(version, paths)
+        new_models.warm_up()
+        _active_models = new_models
+    logger.info("Swapped models %s -> %s", previous, version)
+    return True
+
+
+# Background thread that polls the manifest (or the default weight files)
+# and hot-reloads on a version change
+def watch_manifest(manifest_path=None, interval=30.0):
+    def _watch():
+        while True:
+            time.sleep(interval)
+            try:
+                reload_models(manifest_path)
+            except Exception:
+                logger.exception("Model reload failed; keeping version %s", model_version())
+
+    thread = threading.Thread(target=_watch, name="model-manifest-watch", daemon=True)
+    thread.start()
+    return thread
+
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".jfif", ".webp") + dicom_input.DICOM_EXTENSIONS
 
 # categories
 categories_parts = ["Elbow", "Hand", "Shoulder"]
 categories_fracture = ['fractured', 'normal']
 
-def predict(img, model="Parts"):
-    size = 224
-    if model == 'Parts':
-        chosen_model = model_parts
-    else:
-        if model == 'Elbow':
-            chosen_model = model_elbow_frac
-        elif model == 'Hand':
-            chosen_model = model_hand_frac
-        elif model == 'Shoulder':
-            chosen_model = model_shoulder_frac
+# Confidence gating on the Parts softmax. An image is routed to a single
+# fracture model only if the top bone probability and its margin over the
+# runner-up clear both thresholds; otherwise it is handled by the policy:
+#   "all"    -> score it against all three fracture models in one batched call
+#   "review" -> skip the fracture model and flag it for manual review
+PARTS_MIN_CONFIDENCE = float(os.environ.get("PARTS_MIN_CONFIDENCE", "0.6"))
+PARTS_MIN_MARGIN = float(os.environ.get("PARTS_MIN_MARGIN", "0.2"))
+LOW_CONFIDENCE_POLICY = os.environ.get("LOW_CONFIDENCE_POLICY", "all")
+
+# Test-time augmentation (opt-in). TTA_VIEWS is the number of views K scored
+# per image (0/1 = off); with TTA_BORDERLINE set, only images whose
+# single-view fractured probability lies within that distance of 0.5 are
+# re-scored with the extra views.
+TTA_VIEWS = int(os.environ.get("TTA_VIEWS", "0"))
+TTA_BORDERLINE = float(os.environ["TTA_BORDERLINE"]) if os.environ.get("TTA_BORDERLINE") else None
+TTA_CROP = 0.9
+
+# Study-level verdict over the views of one study: "max" (most suspicious
+# view decides) or "mean" fractured probability
+STUDY_AGGREGATION = os.environ.get("STUDY_AGGREGATION", "max")
+
+# Route DICOM images by their BodyPartExamined header instead of the Parts model
+DICOM_ROUTING_HINTS = os.environ.get("DICOM_ROUTING_HINTS", "1") != "0"
 
+# High-resolution tiled inference for the fracture models (opt-in).
+# TILED_INFERENCE is "off", "borderline" (only images whose fractured
+# probability lies within TILE_BORDERLINE of 0.5) or "all". The source image
+# is re-read at full resolution and cut into TILE_GRID x TILE_GRID tiles
+# overlapping by TILE_OVERLAP of their side; each tile is resized to the
+# model input, so fine detail lost in the 224x224 downsample is seen at up
+# to TILE_GRID times the resolution. All tiles are scored in one batch and
+# combined with the whole-image score by TILE_AGGREGATION ("max" or "mean").
+TILED_INFERENCE = os.environ.get("TILED_INFERENCE", "off")
+TILE_GRID = int(os.environ.get("TILE_GRID", "3"))
+TILE_OVERLAP = float(os.environ.get("TILE_OVERLAP", "0.25"))
+TILE_BORDERLINE = float(os.environ.get("TILE_BORDERLINE", "0.25"))
+TILE_AGGREGATION = os.environ.get("TILE_AGGREGATION", "max")
+
+
+# The analyze_images options that change a verdict, with the defaults
+# filled in, so a caller passing tta=0 and one omitting tta get the same
+# cached result. heatmap and embeddings only add outputs and are left out.
+def result_options(options=None):
+    options = {k: v for k, v in (options or {}).items() if v is not None}
+    resolved = {
+        "min_confidence": options.get("min_confidence", PARTS_MIN_CONFIDENCE),
+        "min_margin": options.get("min_margin", PARTS_MIN_MARGIN),
+        "low_confidence_policy": options.get("low_confidence_policy", LOW_CONFIDENCE_POLICY),
+        "tta": options.get("tta", TTA_VIEWS),
+        "tta_borderline": options.get("tta_borderline", TTA_BORDERLINE),
+        "tiled": options.get("tiled", TILED_INFERENCE),
+    }
+    if resolved["tta"] <= 1:
+        resolved["tta"], resolved["tta_borderline"] = 0, None
+    return resolved
+
+
+def get_model(model="Parts"):
+    return current_models().get(model)
+
+
+# Image paths under a directory (or a .zip such as test.zip, extracted to a temp dir)
+def collect_images(source):
+    if os.path.isfile(source) and zipfile.is_zipfile(source):
+        extracted = tempfile.mkdtemp(prefix="bone_images_")
+        with zipfile.ZipFile(source) as zf:
+            zf.extractall(extracted)
+        source = extracted
+    if os.path.isfile(source):
+        return [source]
+    paths = []
+    for root, _, files in os.walk(source):
+        for name in files:
+            path = os.path.join(root, name)
+            # PACS exports often have no extension; those are found by the DICM magic
+            if name.lower().endswith(IMAGE_EXTENSIONS) or dicom_input.is_dicom(path):
+                paths.append(path)
+    return sorted(paths)
+
+
+# Decode + resize once; returns a (size, size, 3) float array. Arrays that
+# were already preprocessed are passed through so callers can decode once.
+def load_tensor(img, size=224):
+    if isinstance(img, np.ndarray):
+        return img.astype("float32", copy=False)
+    if dicom_input.is_dicom(img):
+        return dicom_input.load_dicom_tensor(img, size)
+    from keras.preprocessing import image
     temp_img = image.load_img(img, target_size=(size, size))
-    x = image.img_to_array(temp_img)
-    x = np.expand_dims(x, axis=0)
-    images = np.vstack([x])
+    return image.img_to_array(temp_img)
 
-    prediction = np.argmax(chosen_model.predict(images), axis=1)
 
-    if model == 'Parts':
-        prediction_str = categories_parts[prediction.item()]
-    else:
-        prediction_str = categories_fracture[prediction.item()]
+# Bone named by a DICOM header (read without pixel data), or None
+def routing_hint(img):
+    if not DICOM_ROUTING_HINTS or not dicom_input.is_dicom(img):
+        return None
+    return dicom_input.bone_hint(img)
+
+
+# K views of one (size, size, 3) image: identity, horizontal flip, then
+# center and corner crops (TTA_CROP of the side) resized back to full size
+def augment_views(x, k):
+    size = x.shape[0]
+    crop = int(round(size * TTA_CROP))
+    off = size - crop
+    mid = off // 2
+
+    tf = _tensorflow()
+
+    def _crop(a, top, left):
+        patch = np.ascontiguousarray(a[top:top + crop, left:left + crop])
+        return tf.image.resize(patch, (size, size)).numpy()
 
-    return prediction_str
+    views = [
+        lambda a: a,
+        lambda a: a[:, ::-1],
+        lambda a: _crop(a, mid, mid),
+        lambda a: _crop(a[:, ::-1], mid, mid),
+        lambda a: _crop(a, 0, 0),
+        lambda a: _crop(a, 0, off),
+        lambda a: _crop(a, off, 0),
+        lambda a: _crop(a, off, off),
+    ]
+    if not 1 <= k <= len(views):
+        raise ValueError(f"TTA supports 1-{len(views)} views, got {k}")
+    return np.stack([view(x) for view in views[:k]])
+
+
+# Score all K views of every image in one predict call and average the
+# probabilities. If base_probs (the identity-view scores) are already known
+# they are reused instead of recomputed.
+@tracing.traced("predictions.tta")
+def predict_tta(chosen_model, x, k, base_probs=None):
+    start = 0 if base_probs is None else 1
+    views = np.concatenate([augment_views(a, k)[start:] for a in x])
+    probs = chosen_model.predict(views, verbose=0, batch_size=inference_config()["batch_size"]).reshape(len(x), k - start, -1)
+    if base_probs is not None:
+        probs = np.concatenate([np.asarray(base_probs)[:, None], probs], axis=1)
+    return probs.mean(axis=1)
+
+
+# Source image as an RGB PIL image at (up to) full resolution. JPEGs are
+# decoded at a reduced scale when that still leaves at least min_side
+# pixels; preprocessed arrays are used as they are. DICOM comes back as a
+# float ("F") image of the windowed pixels in [0, 1], keeping the bit depth
+# the 8-bit preview would throw away.
+def full_resolution(img, min_side=None):
+    if isinstance(img, np.ndarray):
+        return Image.fromarray(np.uint8(np.clip(img, 0, 255)))
+    if dicom_input.is_dicom(img):
+        return Image.fromarray(dicom_input.windowed_pixels(img).astype(np.float32))
+    source = Image.open(img)
+    if min_side:
+        source.draft("RGB", (min_side, min_side))
+    return source.convert("RGB")
+
+
+# grid x grid overlapping tiles of the source image, each resized to the
+# model input: a (grid*grid, size, size, 3) array plus each tile's
+# (left, top, right, bottom) box as fractions of the image, row by row
+def tile_tensors(img, grid=None, overlap=None, size=224):
+    if grid is None:
+        grid = TILE_GRID
+    if overlap is None:
+        overlap = TILE_OVERLAP
+    side = 1.0 / (grid - (grid - 1) * overlap)
+    stride = side * (1.0 - overlap)
+    source = full_resolution(img, min_side=int(size / side))
+    width, height = source.size
+    tiles, boxes = [], []
+    for row in range(grid):
+        for col in range(grid):
+            box = (col * stride, row * stride, min(1.0, col * stride + side), min(1.0, row * stride + side))
+            tile = source.resize((size, size), Image.BILINEAR,
+                                 box=(box[0] * width, box[1] * height, box[2] * width, box[3] * height))
+            tile = np.asarray(tile, dtype=np.float32)
+            if source.mode == "F":
+                # same scaling as dicom_input.load_dicom_tensor
+                tile = np.repeat(tile[..., None] * 255.0, 3, axis=2)
+            tiles.append(tile)
+            boxes.append(box)
+    return np.stack(tiles), boxes
+
+
+# Coarse name of a tile's position ("upper left", "center", ...) by which
+# third of the image its center falls in
+def tile_region(box):
+    cx, cy = (box[0] + box[2]) / 2, (box[1] + box[3]) / 2
+    vertical = ["upper", "middle", "lower"][min(2, int(cy * 3))]
+    horizontal = ["left", "center", "right"][min(2, int(cx * 3))]
+    return "center" if (vertical, horizontal) == ("middle", "center") else f"{vertical} {horizontal}"
+
+
+# Fracture probs of every tile of every source in one predict call:
+# (len(sources), grid*grid, 2) plus the tile boxes
+@tracing.traced("predictions.tiles")
+def predict_tiles(chosen_model, sources, grid=None, overlap=None):
+    tiled = [tile_tensors(img, grid, overlap) for img in sources]
+    x = np.concatenate([tiles for tiles, _ in tiled])
+    probs = chosen_model.predict(x, verbose=0, batch_size=inference_config()["batch_size"])
+    return probs.reshape(len(sources), len(tiled[0][1]), -1), tiled[0][1]
+
+
+# Image-level fractured probability from the whole-image and tile scores,
+# plus where the most suspicious tile is
+def aggregate_tiles(global_prob, tile_probs, boxes, grid, method=None):
+    if method is None:
+        method = TILE_AGGREGATION
+    if method not in ("max", "mean"):
+        raise ValueError(f"Unknown tile aggregation: {method}")
+    # float64 so the rounded percentages serialize as 53.7, not 53.70000076293945
+    fractured = np.asarray(tile_probs, dtype=np.float64)[:, 0]
+    scores = np.concatenate([[global_prob], fractured])
+    prob = float(scores.max() if method == "max" else scores.mean())
+    best = int(np.argmax(fractured))
+    return prob, {
+        "tiles": len(fractured),
+        "tile_aggregation": method,
+        "whole_image_percent": round(float(global_prob) * 100, 1),
+        "tile_percent": np.round(fractured.reshape(grid, grid) * 100, 1).tolist(),
+        "tile_location": [round(v, 3) for v in boxes[best]],
+        "tile_region": tile_region(boxes[best]),
+    }
+
+
+def predict(img, model="Parts"):
+    label, _ = predict_with_scores(img, model)
+    return label
 
 # New helper to return scores without breaking existing API
-def predict_with_scores(img, model="Parts"):
-    size = 224
-    if model == 'Parts':
-        chosen_model = model_parts
-        categories = categories_parts
-    else:
-        if model == 'Elbow':
-            chosen_model = model_elbow_frac
-        elif model == 'Hand':
-            chosen_model = model_hand_frac
-        elif model == 'Shoulder':
-            chosen_model = model_shoulder_frac
-        categories = categories_fracture
+def predict_with_scores(img, model="Parts", tta=0):
+    chosen_model = get_model(model)
+    categories = categories_parts if model == 'Parts' else categories_fracture
 
-    temp_img = image.load_img(img, target_size=(size, size))
-    x = image.img_to_array(temp_img)
-    x = np.expand_dims(x, axis=0)
-    images = np.vstack([x])
+    x = np.expand_dims(load_tensor(img), axis=0)
 
-    probs = chosen_model.predict(images)[0]
+    if tta > 1:
+        probs = predict_tta(chosen_model, x, tta)[0]
+    else:
+        probs = chosen_model.predict(x, verbose=0)[0]
     idx = int(np.argmax(probs))
     label = categories[idx]
     return label, probs.tolist()
 
-# High-level analysis returning structured output for UI
-def analyze_image(img_path):
-    bone_label, bone_probs = predict_with_scores(img_path, 'Parts')
-    if bone_label not in categories_parts:
-        return {
-            "fracture_present": None,
-            "bone": None,
-            "fracture_type": "Unknown",
-            "severity_percent": None
-        }
 
-    frac_label, frac_probs = predict_with_scores(img_path, bone_label)
-    # fracture probs are ordered as ['fractured', 'normal']
-    fractured_prob = float(frac_probs[0]) if len(frac_probs) > 0 else 0.0
-    severity_percent = round(fractured_prob * 100, 1)
+# Last layer with a spatial output (conv5_block3_out for the ResNet50 models).
+# Uses layer.output rather than output_shape, which Keras 3 removed.
+def _last_conv_layer(chosen_model):
+    for layer in reversed(chosen_model.layers):
+        shape = getattr(layer.output, "shape", None)
+        if shape is not None and len(shape) == 4:
+            return layer
+    raise ValueError(f"No convolutional feature map found in {chosen_model.name}")
+
+
+# Fracture probabilities, the pooled last-conv embedding (global average of
+# the feature map) and optionally a Grad-CAM heatmap of the 'fractured'
+# class for every image, all from one forward pass (plus one backward pass
+# for the heatmap). Heatmaps are (h, w) in [0, 1] at feature-map resolution.
+def predict_with_features(model, x, models=None, heatmap=False):
+    batch_size = inference_config()["batch_size"]
+    if len(x) > batch_size:
+        chunks = [predict_with_features(model, x[i:i + batch_size], models, heatmap)
+                  for i in range(0, len(x), batch_size)]
+        probs, cams, embeddings = zip(*chunks)
+        return (np.concatenate(probs), np.concatenate(cams) if heatmap else None,
+                np.concatenate(embeddings))
+    tf = _tensorflow()
+    grad_model = (models or current_models()).grad_model(model)
+    inputs = tf.convert_to_tensor(x)
+    cam = None
+    if heatmap:
+        with tf.GradientTape() as tape:
+            conv_out, probs = grad_model(inputs, training=False)
+            score = probs[:, 0]
+        grads = tape.gradient(score, conv_out)
+        channel_weights = tf.reduce_mean(grads, axis=(1, 2))
+        cam = tf.nn.relu(tf.einsum("nhwc,nc->nhw", conv_out, channel_weights))
+        cam = np.array(cam / (tf.reduce_max(cam, axis=(1, 2), keepdims=True) + 1e-8))
+    else:
+        conv_out, probs = grad_model(inputs, training=False)
+    embedding = tf.reduce_mean(conv_out, axis=(1, 2))
+    return np.array(probs), cam, np.array(embedding)
+
+
+def predict_with_heatmap(model, x, models=None):
+    probs, cam, _ = predict_with_features(model, x, models, heatmap=True)
+    return probs, cam
+
 
-    if frac_label == 'fractured':
+# predict_with_scores plus the model's pooled embedding from the same forward pass
+def predict_with_embedding(img, model="Parts"):
+    probs, _, embedding = predict_with_features(model, load_tensor(img)[None])
+    categories = categories_parts if model == "Parts" else categories_fracture
+    return categories[int(np.argmax(probs[0]))], probs[0].tolist(), embedding[0].astype(np.float16)
+
+
+# Top-1 probability and its margin over the runner-up
+def parts_confidence(bone_probs):
+    ranked = np.sort(np.asarray(bone_probs, dtype=float))[::-1]
+    return float(ranked[0]), float(ranked[0] - ranked[1])
+
+
+def _fracture_result(bone_label, fractured_prob, fractured):
+    if fractured:
         fracture_type = f"Fracture in {bone_label} (type not classified)"
-        fracture_present = True
     else:
         fracture_type = f"No fracture detected in {bone_label}"
-        fracture_present = False
-
     return {
-        "fracture_present": fracture_present,
+        "fracture_present": fractured,
         "bone": bone_label,
         "fracture_type": fracture_type,
-        "severity_percent": severity_percent
+        "severity_percent": round(fractured_prob * 100, 1),
     }
+
+
+# Batched cascade: one Parts predict for all images, then one fracture
+# predict per bone group (plus one combined call for low-confidence images).
+# bone_hints (one bone or None per image, by default read from DICOM
+# headers) route an image straight to its fracture model without Parts.
+# With embeddings=True, images routed to a single fracture model also get
+# that model's pooled "embedding" (float16 array, not JSON-serializable)
+# from the same forward pass. tiled ("off", "borderline", "all"; default
+# TILED_INFERENCE) re-scores single-routed images as full-resolution tiles
+# read from tile_sources (default imgs; pass the original files when imgs
+# are preprocessed arrays). With the pre-filter on (PREFILTER by default),
+# images it rejects get prefilter.rejection_result and never reach a model;
+# images with a bone hint are not screened.
+@tracing.traced("predictions.analyze_images")
+def analyze_images(imgs, min_confidence=None, min_margin=None, low_confidence_policy=None,
+                   tta=None, tta_borderline=None, heatmap=False, bone_hints=None, embeddings=False,
+                   prefilter_images=None, tiled=None, tile_sources=None):
+    if min_confidence is None:
+        min_confidence = PARTS_MIN_CONFIDENCE
+    if min_margin is None:
+        min_margin = PARTS_MIN_MARGIN
+    if low_confidence_policy is None:
+        low_confidence_policy = LOW_CONFIDENCE_POLICY
+    if tta is None:
+        tta = TTA_VIEWS
+    if tta_borderline is None:
+        tta_borderline = TTA_BORDERLINE
+    if prefilter_images is None:
+        prefilter_images = prefilter.PREFILTER_ENABLED
+    if tiled is None:
+        tiled = TILED_INFERENCE
+    if tile_sources is None:
+        tile_sources = imgs
+    if low_confidence_policy not in ("all", "review"):
+        raise ValueError(f"Unknown low_confidence_policy: {low_confidence_policy}")
+    if tiled not in ("off", "borderline", "all"):
+        raise ValueError(f"Unknown tiled mode: {tiled}")
+
+    if len(imgs) == 0:
+        return []
+
+    if bone_hints is None:
+        bone_hints = [routing_hint(img) for img in imgs]
+
+    with tracing.span("predictions.current_models"):
+        models = current_models()
+    batch_size = inference_config()["batch_size"]
+    with tracing.span("predictions.load_tensors", images=len(imgs)):
+        x = np.stack([load_tensor(img) for img in imgs])
+
+    results = [None] * len(imgs)
+    routed = {bone: [] for bone in categories_parts}
+    uncertain = []
+    for i, hint in enumerate(bone_hints):
+        if hint is not None:
+            results[i] = {
+                "fracture_present": None,
+                "bone": hint,
+                "fracture_type": None,
+                "severity_percent": None,
+                "bone_confidence": 100.0,
+                "needs_review": False,
+                "routing": "skipped",
+                "bone_source": "dicom_header",
+                "model_version": models.version,
+            }
+            routed[hint].append(i)
+
+    if prefilter_images:
+        with tracing.span("prefilter.screen", images=len(imgs)):
+            for i, hint in enumerate(bone_hints):
+                if hint is None:
+                    verdict = prefilter.screen(x[i])
+                    if not verdict["accepted"]:
+                        results[i] = prefilter.rejection_result(verdict, models.version)
+
+    parts_idx = [i for i, hint in enumerate(bone_hints) if hint is None and results[i] is None]
+    bone_probs = [None] * len(imgs)
+    parts_probs = []
+    if parts_idx:
+        with tracing.span("predictions.predict.Parts", batch=len(parts_idx)):
+            parts_probs = models.get('Parts').predict(x[parts_idx], verbose=0, batch_size=batch_size)
+    for i, probs in zip(parts_idx, parts_probs):
+        bone_probs[i] = probs
+        bone_label = categories_parts[int(np.argmax(probs))]
+        confidence, margin = parts_confidence(probs)
+        confident = confidence >= min_confidence and margin >= min_margin
+        # routed/uncertain images get their fracture fields filled in below
+        results[i] = {
+            "fracture_present": None,
+            "bone": bone_label,
+            "fracture_type": f"Uncertain bone type ({bone_label}?) - flagged for review",
+            "severity_percent": None,
+            "bone_confidence": round(confidence * 100, 1),
+            "needs_review": not confident,
+            "routing": "skipped",
+            "model_version": models.version,
+        }
+        if confident:
+            routed[bone_label].append(i)
+        elif low_confidence_policy == "all":
+            uncertain.append(i)
+
+    # fracture probs are ordered as ['fractured', 'normal']
+    for bone_label, idx in routed.items():
+        if not idx:
+            continue
+        chosen_model = models.get(bone_label)
+        with tracing.span(f"predictions.predict.{bone_label}", batch=len(idx), heatmap=heatmap):
+            if heatmap or embeddings:
+                frac_probs, heatmaps, pooled = predict_with_features(bone_label, x[idx], models, heatmap=heatmap)
+            else:
+                frac_probs = chosen_model.predict(x[idx], verbose=0, batch_size=batch_size)
+        views = np.ones(len(idx), dtype=int)
+        if tta > 1:
+            if tta_borderline is None:
+                redo = np.arange(len(idx))
+            else:
+                redo = np.flatnonzero(np.abs(frac_probs[:, 0] - 0.5) < tta_borderline)
+            if len(redo):
+                frac_probs[redo] = predict_tta(chosen_model, x[idx][redo], tta, base_probs=frac_probs[redo])
+                views[redo] = tta
+        tile_info = {}
+        if tiled != "off":
+            if tiled == "all":
+                retile = np.arange(len(idx))
+            else:
+                retile = np.flatnonzero(np.abs(frac_probs[:, 0] - 0.5) < TILE_BORDERLINE)
+            if len(retile):
+                tile_probs, boxes = predict_tiles(chosen_model, [tile_sources[idx[j]] for j in retile])
+                for j, probs in zip(retile, tile_probs):
+                    prob, tile_info[j] = aggregate_tiles(float(frac_probs[j][0]), probs, boxes, TILE_GRID)
+                    frac_probs[j] = [prob, 1.0 - prob]
+        for j, (i, probs) in enumerate(zip(idx, frac_probs)):
+            fractured = categories_fracture[int(np.argmax(probs))] == 'fractured'
+            results[i].update(_fracture_result(bone_label, float(probs[0]), fractured))
+            results[i]["routing"] = "single"
+            results[i]["tta_views"] = int(views[j])
+            if j in tile_info:
+                results[i].update(tile_info[j])
+            if heatmap:
+                # identity-view heatmap, rounded to keep the cached result small
+                results[i]["heatmap"] = np.round(heatmaps[j], 3).tolist()
+            if embeddings:
+                results[i]["embedding"] = pooled[j].astype(np.float16)
+
+    if uncertain:
+        with tracing.span("predictions.predict.all_fracture", batch=len(uncertain)):
+            outputs = models.all_fracture_model().predict(x[uncertain], verbose=0, batch_size=batch_size)
+        for j, i in enumerate(uncertain):
+            by_bone = {bone: float(outputs[k][j][0]) for k, bone in enumerate(categories_parts)}
+            # marginalize the fractured probability over the Parts posterior
+            fractured_prob = float(sum(bone_probs[i][k] * by_bone[bone]
+                                       for k, bone in enumerate(categories_parts)))
+            bone_label = categories_parts[int(np.argmax(bone_probs[i]))]
+            results[i].update(_fracture_result(bone_label, fractured_prob, fractured_prob >= 0.5))
+            results[i]["routing"] = "all"
+            results[i]["fractured_by_bone"] = by_bone
+
+    return results
+
+
+# High-level analysis returning structured output for UI
+def analyze_image(img_path, **kwargs):
+    return analyze_images([img_path], **kwargs)[0]
+
+
+# Aggregate the analyze_images results of one study's views (AP, lateral,
+# oblique, ...) into a single verdict. The study bone is the majority bone
+# of the routed views; disagreeing bones or any flagged view flag the study.
+# The per-view results are kept under "view_results", and the view that
+# drove the verdict (highest fractured probability) under
+# "representative_view".
+def aggregate_study(results, method=None):
+    if method is None:
+        method = STUDY_AGGREGATION
+    if method not in ("max", "mean"):
+        raise ValueError(f"Unknown study aggregation: {method}")
+    if len(results) == 0:
+        raise ValueError("A study needs at least one view")
+
+    # views turned away by the pre-filter take no part in the verdict
+    kept = [i for i, r in enumerate(results) if r.get("routing") != "rejected"]
+    if not kept:
+        raise ValueError("Every view of the study was rejected by the pre-filter")
+    scored = [i for i in kept if results[i].get("severity_percent") is not None]
+    bones = Counter(results[i]["bone"] for i in (scored or kept))
+    bone_label = bones.most_common(1)[0][0]
+    study = {
+        "bone": bone_label,
+        "bone_confidence": round(float(np.mean([results[i]["bone_confidence"] for i in kept
+                                                if results[i]["bone"] == bone_label])), 1),
+        "needs_review": not scored or len(bones) > 1 or any(r.get("needs_review") for r in results),
+        "routing": "study",
+        "aggregation": method,
+        "views": len(results),
+        "scored_views": len(scored),
+        "rejected_views": len(results) - len(kept),
+        "model_version": results[0].get("model_version"),
+        "view_results": results,
+    }
+    if not scored:
+        study.update({
+            "fracture_present": None,
+            "fracture_type": f"Uncertain bone type ({bone_label}?) in every view - flagged for review",
+            "severity_percent": None,
+            "representative_view": kept[0],
+        })
+        return study
+
+    probs = np.array([results[i]["severity_percent"] / 100.0 for i in scored])
+    fractured_prob = float(probs.max() if method == "max" else probs.mean())
+    representative = scored[int(np.argmax(probs))]
+    study.update(_fracture_result(bone_label, fractured_prob, fractured_prob >= 0.5))
+    study["fractured_views"] = sum(bool(results[i]["fracture_present"]) for i in scored)
+    study["representative_view"] = representative
+    if results[representative].get("heatmap") is not None:
+        study["heatmap"] = results[representative]["heatmap"]
+    return study
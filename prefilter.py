@@ -0,0 +1,238 @@
+# Pre-filter that turns away uploads the cascade can't handle.
+#
+#   python prefilter.py check photo.jpg scan.png
+#   python prefilter.py train --accept test.zip --reject not_xrays/ chest_xrays/
+#
+# The Parts model always answers Elbow, Hand or Shoulder, whatever it is
+# shown, so screenshots, photos and out-of-scope anatomy used to get a
+# confident-looking fracture verdict. Before the cascade, every image is
+# reduced to a 32x32 thumbnail of its preprocessed tensor and screened in
+# well under a millisecond:
+#   1. fixed rules on image statistics catch what is obviously not a
+#      radiograph (colour photos, blank images, screenshots/documents with
+#      few grey levels, diagrams with hard edges);
+#   2. if PREFILTER_WEIGHTS exists, a logistic classifier over those
+#      statistics plus a 4x4 intensity layout scores how likely the image is
+#      a supported radiograph, and scores below PREFILTER_THRESHOLD are
+#      rejected. `train` fits it from folders of accepted and rejected
+#      examples; out-of-scope anatomy (chest, skull, foot films) can only be
+#      caught by training with such examples.
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+PREFILTER_ENABLED = os.environ.get("PREFILTER", "1") != "0"
+PREFILTER_WEIGHTS = os.environ.get("PREFILTER_WEIGHTS", "weights/prefilter.json")
+PREFILTER_THRESHOLD = float(os.environ.get("PREFILTER_THRESHOLD", "0.5"))
+
+# Rule limits, calibrated on test.zip (all pass) and the README images (all fail)
+MAX_CHROMA = 0.1
+MIN_CONTRAST = 0.04
+MIN_ENTROPY = 2.0
+MAX_EDGE_FRACTION = 0.15
+
+THUMBNAIL_SIZE = 32
+FEATURE_NAMES = (["chroma", "mean", "contrast", "dark", "bright", "gradient", "flat", "edges", "entropy",
+                  "border_minus_center"] + [f"layout_{i}" for i in range(16)])
+
+_classifier_cache = {}
+
+
+# (32, 32, 3) thumbnail in [0, 1] of a (224, 224, 3) tensor in [0, 255]
+def thumbnail(x):
+    x = np.asarray(x, dtype=np.float32)
+    cell = x.shape[0] // THUMBNAIL_SIZE
+    x = x[:cell * THUMBNAIL_SIZE, :cell * THUMBNAIL_SIZE]
+    return x.reshape(THUMBNAIL_SIZE, cell, THUMBNAIL_SIZE, cell, 3).mean(axis=(1, 3)) / 255.0
+
+
+def features(x):
+    thumb = thumbnail(x)
+    gray = thumb.mean(axis=2)
+    diffs = np.concatenate([np.abs(np.diff(gray, axis=0)).ravel(), np.abs(np.diff(gray, axis=1)).ravel()])
+    hist = np.histogram(gray, bins=16, range=(0.0, 1.0))[0] / gray.size
+    hist = hist[hist > 0]
+    border = np.concatenate([gray[:4].ravel(), gray[-4:].ravel(), gray[4:-4, :4].ravel(), gray[4:-4, -4:].ravel()])
+    layout = gray.reshape(4, 8, 4, 8).mean(axis=(1, 3)).ravel()
+    return np.array([
+        np.abs(thumb - gray[..., None]).mean(),
+        gray.mean(),
+        gray.std(),
+        (gray < 0.1).mean(),
+        (gray > 0.9).mean(),
+        diffs.mean(),
+        (diffs < 0.005).mean(),
+        (diffs > 0.2).mean(),
+        -(hist * np.log2(hist)).sum(),
+        border.mean() - gray[8:-8, 8:-8].mean(),
+    ] + list(layout), dtype=np.float32)
+
+
+# Reason the rules reject an image, or None
+def rule_violation(f):
+    chroma, contrast, edges, entropy = f[0], f[2], f[7], f[8]
+    if chroma > MAX_CHROMA:
+        return "it is a colour image, not a radiograph"
+    if contrast < MIN_CONTRAST:
+        return "the image is blank or nearly uniform"
+    if entropy < MIN_ENTROPY:
+        return "it has too few grey levels for an X-ray (screenshot, document or icon?)"
+    if edges > MAX_EDGE_FRACTION:
+        return "it has the hard edges of a drawing or diagram, not an X-ray"
+    return None
+
+
+def _classifier(weights):
+    classifier = {key: np.asarray(weights[key], dtype=np.float32) for key in ("mean", "scale", "coef")}
+    classifier["bias"] = float(weights["bias"])
+    return classifier
+
+
+# Trained classifier from PREFILTER_WEIGHTS, or None; reloaded when the file changes
+def load_classifier(path=None):
+    path = path or PREFILTER_WEIGHTS
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    cached = _classifier_cache.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path) as f:
+            weights = json.load(f)
+        if weights.get("features") != FEATURE_NAMES:
+            raise ValueError(f"{path} was trained on different features; retrain it with `prefilter.py train`")
+        cached = (mtime, _classifier(weights))
+        _classifier_cache[path] = cached
+    return cached[1]
+
+
+def _score(classifier, f):
+    z = (f - classifier["mean"]) / classifier["scale"]
+    return float(1.0 / (1.0 + np.exp(-(z @ classifier["coef"] + classifier["bias"]))))
+
+
+# {"accepted", "score", "reason"} for one preprocessed (224, 224, 3) tensor.
+# score is the classifier's probability of a supported radiograph (None
+# without a classifier or when a rule already rejected the image).
+def screen(x, threshold=None, classifier_path=None):
+    if threshold is None:
+        threshold = PREFILTER_THRESHOLD
+    f = features(x)
+    reason = rule_violation(f)
+    if reason is not None:
+        return {"accepted": False, "score": None, "reason": reason}
+    classifier = load_classifier(classifier_path)
+    if classifier is None:
+        return {"accepted": True, "score": None, "reason": None}
+    score = _score(classifier, f)
+    if score < threshold:
+        return {"accepted": False, "score": round(score, 4),
+                "reason": "it does not look like an elbow, hand or shoulder X-ray"}
+    return {"accepted": True, "score": round(score, 4), "reason": None}
+
+
+# analyze_images-shaped result for a rejected image; the cascade never ran
+def rejection_result(verdict, model_version=None):
+    return {
+        "fracture_present": None,
+        "bone": None,
+        "fracture_type": f"Not analyzed: {verdict['reason']}",
+        "severity_percent": None,
+        "bone_confidence": None,
+        "needs_review": False,
+        "routing": "rejected",
+        "rejected_reason": verdict["reason"],
+        "prefilter_score": verdict["score"],
+        "model_version": model_version,
+    }
+
+
+# Class-balanced L2-regularized logistic regression by gradient descent;
+# returns the weights dict saved as JSON
+def fit(accepted, rejected, l2=0.01, iterations=3000, lr=0.5):
+    x = np.concatenate([accepted, rejected]).astype(np.float64)
+    y = np.concatenate([np.ones(len(accepted)), np.zeros(len(rejected))])
+    sample_weight = np.where(y == 1, 0.5 / len(accepted), 0.5 / len(rejected))
+    mean, scale = x.mean(axis=0), x.std(axis=0) + 1e-6
+    z = (x - mean) / scale
+    coef, bias = np.zeros(x.shape[1]), 0.0
+    for _ in range(iterations):
+        p = 1.0 / (1.0 + np.exp(-(z @ coef + bias)))
+        error = (p - y) * sample_weight
+        coef -= lr * (z.T @ error + l2 * coef)
+        bias -= lr * error.sum()
+    return {"features": FEATURE_NAMES, "mean": mean.tolist(), "scale": scale.tolist(),
+            "coef": coef.tolist(), "bias": bias}
+
+
+def _feature_rows(sources):
+    import predictions
+
+    paths = [p for source in sources for p in predictions.collect_images(source)]
+    if not paths:
+        raise SystemExit(f"No images found in {', '.join(sources)}")
+    return paths, np.stack([features(predictions.load_tensor(p)) for p in paths])
+
+
+def train(args):
+    accepted_paths, accepted = _feature_rows(args.accept)
+    rejected_paths, rejected = _feature_rows(args.reject)
+    weights = fit(accepted, rejected, l2=args.l2)
+    classifier = _classifier(weights)
+    for name, paths, rows, expected in (("accept", accepted_paths, accepted, True),
+                                        ("reject", rejected_paths, rejected, False)):
+        scores = np.array([_score(classifier, f) for f in rows])
+        wrong = [p for p, s in zip(paths, scores) if (s >= args.threshold) != expected]
+        print(f"{name}: {len(paths) - len(wrong)}/{len(paths)} correct at threshold {args.threshold}, "
+              f"scores {scores.min():.3f}-{scores.max():.3f}")
+        for path in wrong[:10]:
+            print(f"  misclassified: {path}")
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(weights, f, indent=2)
+    print(f"Saved {args.output}")
+
+
+def check(args):
+    import predictions
+
+    for source in args.images:
+        for path in predictions.collect_images(source):
+            x = predictions.load_tensor(path)
+            start = time.perf_counter()
+            verdict = screen(x, args.threshold, args.weights)
+            elapsed = (time.perf_counter() - start) * 1000
+            status = "accept" if verdict["accepted"] else "reject"
+            score = "" if verdict["score"] is None else f" score {verdict['score']:.3f}"
+            reason = f" ({verdict['reason']})" if verdict["reason"] else ""
+            print(f"{status}{score} {elapsed:.2f}ms {path}{reason}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Screen uploads before the fracture cascade")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    check_parser = sub.add_parser("check", help="print the pre-filter verdict for images")
+    check_parser.add_argument("images", nargs="+", help="images, directories or .zip files")
+    check_parser.add_argument("--threshold", type=float, default=PREFILTER_THRESHOLD)
+    check_parser.add_argument("--weights", default=PREFILTER_WEIGHTS)
+    check_parser.set_defaults(func=check)
+
+    train_parser = sub.add_parser("train", help="fit the classifier on accepted and rejected examples")
+    train_parser.add_argument("--accept", nargs="+", required=True, help="supported radiographs (e.g. test.zip)")
+    train_parser.add_argument("--reject", nargs="+", required=True,
+                              help="non-radiographs and out-of-scope anatomy")
+    train_parser.add_argument("--output", default=PREFILTER_WEIGHTS)
+    train_parser.add_argument("--threshold", type=float, default=PREFILTER_THRESHOLD)
+    train_parser.add_argument("--l2", type=float, default=0.01)
+    train_parser.set_defaults(func=train)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+# Persistent study/result store (SQLite).
+#
+# Every analysis is recorded with its content hash, perceptual hash, bone,
+# label and timestamp (all indexed), together with the full result JSON and
+# the chat transcript of the session that produced it. The GUI restores
+# sessions from it after a refresh and the batch tools skip images whose
+# result is already stored.
+import json
+import os
+import sqlite3
+import threading
+import time
+
+RESULT_STORE_PATH = os.environ.get("RESULT_STORE_PATH", "results.db")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS analyses (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    content_hash TEXT NOT NULL,
+    phash INTEGER,
+    options TEXT NOT NULL,
+    model_version TEXT,
+    source TEXT,
+    bone TEXT,
+    label TEXT,
+    severity_percent REAL,
+    needs_review INTEGER,
+    result TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_analyses_hash ON analyses(content_hash, options, model_version);
+CREATE INDEX IF NOT EXISTS idx_analyses_bone ON analyses(bone, created_at);
+CREATE INDEX IF NOT EXISTS idx_analyses_label ON analyses(label, created_at);
+CREATE INDEX IF NOT EXISTS idx_analyses_created ON analyses(created_at);
+
+CREATE TABLE IF NOT EXISTS chat_messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_id TEXT NOT NULL,
+    analysis_id INTEGER REFERENCES analyses(id),
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_chat_session ON chat_messages(session_id, id);
+
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    analysis_id INTEGER REFERENCES analyses(id),
+    updated_at REAL NOT NULL
+);
+"""
+
+
+# 'fractured' / 'normal', or 'review' when the fracture model was skipped
+def result_label(result):
+    if result.get("fracture_present") is None:
+        return "review"
+    return "fractured" if result["fracture_present"] else "normal"
+
+
+# Canonical form of the analyze_image options a result was computed with
+# (see predictions.result_options)
+def options_key(options=None):
+    import predictions
+
+    return json.dumps(predictions.result_options(options), sort_keys=True)
+
+
+class ResultStore:
+    def __init__(self, path=RESULT_STORE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        # one connection shared by Streamlit's session threads, serialized by the lock
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(_SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _analysis_row(self, row):
+        if row is None:
+            return None
+        result = json.loads(row["result"])
+        result["analysis_id"] = row["id"]
+        return result
+
+    def record_analysis(self, content_hash, result, options=None, phash=None, source=None,
+                        model_version=None):
+        stored = {k: v for k, v in result.items() if k not in ("analysis_id", "dedup_hit")}
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "INSERT INTO analyses (content_hash, phash, options, model_version, source, bone, label, "
+                "severity_percent, needs_review, result, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (content_hash, phash, options_key(options), model_version, source, result.get("bone"),
+                 result_label(result), result.get("severity_percent"),
+                 int(bool(result.get("needs_review"))), json.dumps(stored), time.time()),
+            )
+        return cursor.lastrowid
+
+    def get_analysis(self, analysis_id):
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM analyses WHERE id = ?", (analysis_id,)).fetchone()
+        return self._analysis_row(row)
+
+    # Latest stored result for this content hash and option set, or None.
+    # With model_version, results computed by other weights are ignored.
+    def find_by_hash(self, content_hash, options=None, model_version=None):
+        return self.find_many([content_hash], options, model_version).get(content_hash)
+
+    # {content_hash: latest result} for the hashes that have a stored result
+    def find_many(self, content_hashes, options=None, model_version=None):
+        found = {}
+        hashes = list(dict.fromkeys(content_hashes))
+        version_clause = " AND model_version = ?" if model_version is not None else ""
+        for offset in range(0, len(hashes), 500):
+            chunk = hashes[offset:offset + 500]
+            params = chunk + [options_key(options)] + ([model_version] if model_version is not None else [])
+            with self._lock:
+                rows = self._conn.execute(
+                    f"SELECT * FROM analyses WHERE content_hash IN ({','.join('?' * len(chunk))}) "
+                    f"AND options = ?{version_clause} ORDER BY id",
+                    params,
+                ).fetchall()
+            for row in rows:
+                found[row["content_hash"]] = self._analysis_row(row)
+        return found
+
+    # Most recent analyses as (content_hash, phash, options, result) for warming a DedupIndex
+    def recent_hashes(self, limit):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM analyses ORDER BY id DESC LIMIT ?", (limit,)
+            ).fetchall()
+        return [(row["content_hash"], row["phash"], json.loads(row["options"]), self._analysis_row(row))
+                for row in reversed(rows)]
+
+    # Past studies filtered by bone / label ('fractured', 'normal', 'review') / time range
+    def query(self, bone=None, label=None, since=None, until=None, limit=100):
+        clauses, params = [], []
+        if bone is not None:
+            clauses.append("bone = ?")
+            params.append(bone)
+        if label is not None:
+            clauses.append("label = ?")
+            params.append(label)
+        if since is not None:
+            clauses.append("created_at >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("created_at < ?")
+            params.append(until)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT * FROM analyses {where} ORDER BY created_at DESC LIMIT ?",
+                params + [limit],
+            ).fetchall()
+        return [dict(self._analysis_row(row), content_hash=row["content_hash"], source=row["source"],
+                     created_at=row["created_at"]) for row in rows]
+
+    def add_chat_message(self, session_id, role, content, analysis_id=None):
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "INSERT INTO chat_messages (session_id, analysis_id, role, content, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (session_id, analysis_id, role, content, time.time()),
+            )
+        return cursor.lastrowid
+
+    # Messages of a session in order. With limit, only the newest `limit`
+    # messages (older than before_id, if given) are returned, so long
+    # conversations can be paged from the end.
+    def chat_transcript(self, session_id, limit=None, before_id=None):
+        sql = "SELECT id, role, content FROM chat_messages WHERE session_id = ?"
+        params = [session_id]
+        if before_id is not None:
+            sql += " AND id < ?"
+            params.append(before_id)
+        sql += " ORDER BY id DESC"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [{"id": row["id"], "role": row["role"], "content": row["content"]} for row in reversed(rows)]
+
+    def count_chat_messages(self, session_id, before_id=None):
+        sql = "SELECT COUNT(*) FROM chat_messages WHERE session_id = ?"
+        params = [session_id]
+        if before_id is not None:
+            sql += " AND id < ?"
+            params.append(before_id)
+        with self._lock:
+            return self._conn.execute(sql, params).fetchone()[0]
+
+    def set_session_analysis(self, session_id, analysis_id):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO sessions (session_id, analysis_id, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(session_id) DO UPDATE SET analysis_id = excluded.analysis_id, "
+                "updated_at = excluded.updated_at",
+                (session_id, analysis_id, time.time()),
+            )
+
+    # (analysis result or None, chat transcript) of a previous session; the
+    # transcript is limited to the newest chat_limit messages if given
+    def load_session(self, session_id, chat_limit=None):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT a.* FROM sessions s JOIN analyses a ON a.id = s.analysis_id "
+                "WHERE s.session_id = ?",
+                (session_id,),
+            ).fetchone()
+        analysis = None
+        if row is not None:
+            analysis = dict(self._analysis_row(row), source=row["source"])
+        return analysis, self.chat_transcript(session_id, limit=chat_limit)
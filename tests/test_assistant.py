@@ -0,0 +1,54 @@
+import assistant
+
+
+class CountingClient:
+    def __init__(self):
+        self.calls = 0
+
+    def generate(self, prompt, max_new_tokens=150, temperature=0.7):
+        self.calls += 1
+        return f"answer {self.calls}"
+
+
+def ask(prompt, history, cache, client, bone="Hand", prediction="fractured"):
+    answer = assistant.quick_answer(prompt, bone, prediction, cache, history=history)
+    if answer is None:
+        answer = assistant.llm_answer(prompt, bone, prediction, client, cache=cache, history=history)
+    history += [{"role": "user", "content": prompt}, {"role": "assistant", "content": answer}]
+    return answer
+
+
+def greeted(bone="Hand", prediction="fractured"):
+    return [{"role": "assistant", "content": assistant.analysis_message(bone, prediction)}]
+
+
+def test_second_session_reuses_first_free_text_answer():
+    cache, client = assistant.ResponseCache(), CountingClient()
+    first = ask("Can I drive a car?", greeted(), cache, client)
+    second = ask("can I drive my car", greeted(), cache, client)
+    assert second == first
+    assert client.calls == 1
+    assert cache.stats()["hits"] == 1
+
+
+def test_follow_up_questions_bypass_the_cache():
+    cache, client = assistant.ResponseCache(), CountingClient()
+    ask("Can I drive a car?", greeted(), cache, client)
+    history = greeted()
+    ask("Is it swollen?", history, cache, client)
+    ask("Can I drive a car?", history, cache, client)
+    assert client.calls == 3
+    assert cache.stats()["size"] == 2
+
+
+def test_new_analysis_reopens_the_conversation():
+    history = greeted() + [{"role": "user", "content": "Is it swollen?"}, {"role": "assistant", "content": "No"}]
+    assert not assistant.is_opening_question(history)
+    assert assistant.is_opening_question(history + greeted("Elbow", "normal"))
+
+
+def test_cache_is_keyed_on_the_finding():
+    cache, client = assistant.ResponseCache(), CountingClient()
+    ask("Can I drive a car?", greeted(), cache, client)
+    ask("Can I drive a car?", greeted("Hand", "normal"), cache, client, prediction="normal")
+    assert client.calls == 2
@@ -0,0 +1,44 @@
+import numpy as np
+
+import dicom_input
+import predictions
+
+
+def fake_dicom(tmp_path, name="IM0001"):
+    path = tmp_path / name
+    path.write_bytes(b"\0" * 128 + b"DICM" + b"\0" * 64)
+    return str(path)
+
+
+def test_tiles_are_cut_from_the_float_pixels(tmp_path, monkeypatch):
+    # a smooth 12-bit-like ramp that an 8-bit preview would quantize to 256 levels
+    pixels = np.linspace(0.0, 1.0, 600 * 800, dtype=np.float32).reshape(600, 800)
+    monkeypatch.setattr(dicom_input, "windowed_pixels", lambda path: pixels)
+    path = fake_dicom(tmp_path)
+
+    assert predictions.full_resolution(path).mode == "F"
+    tiles, boxes = predictions.tile_tensors(path, grid=2, overlap=0.25, size=224)
+
+    assert tiles.shape == (4, 224, 224, 3)
+    assert tiles.dtype == np.float32
+    assert len(boxes) == 4
+    assert np.array_equal(tiles[..., 0], tiles[..., 1]) and np.array_equal(tiles[..., 0], tiles[..., 2])
+    assert 0.0 <= tiles.min() and tiles.max() <= 255.0
+    assert not np.allclose(tiles, np.round(tiles))
+
+
+def test_tile_scaling_matches_the_whole_image_tensor(tmp_path, monkeypatch):
+    pixels = np.full((448, 448), 0.25, dtype=np.float32)
+    monkeypatch.setattr(dicom_input, "windowed_pixels", lambda path: pixels)
+    path = fake_dicom(tmp_path)
+
+    tiles, _ = predictions.tile_tensors(path, grid=2, overlap=0.0, size=224)
+    whole = dicom_input.load_dicom_tensor(path)
+    assert np.allclose(tiles, 63.75)
+    assert np.allclose(whole, 63.75)
+
+
+def test_extensionless_dicom_files_are_collected(tmp_path):
+    dicom = fake_dicom(tmp_path)
+    (tmp_path / "notes").write_text("not an image")
+    assert predictions.collect_images(str(tmp_path)) == [dicom]
@@ -0,0 +1,228 @@
+# Request tracing with correlation IDs, exported as Chrome trace events.
+#
+#   TRACE_PATH=traces.json streamlit run mainGUI.py
+#   python tracing.py summary traces.json --top 10
+#
+# A user action (an upload, an Analyze click, a chat message) opens a root
+# span. An upload gets a fresh correlation ID, and the analysis and chat
+# messages about it reuse that ID, so one trace covers upload -> analysis
+# -> assistant. Nested span() calls in the same context
+# (predictions.py, dedup.py, the admission gates, the assistant client)
+# become its children, and the ID travels with assistant requests so the
+# worker process's spans carry it too. The ID lives in a contextvar, so
+# concurrent Streamlit sessions never mix their spans.
+#
+# Spans are buffered per root and appended to TRACE_PATH when the root ends
+# (only roots of at least TRACE_MIN_MS, to keep just the slow tail), as
+# "complete" events in the Trace Event JSON array format. The file can be
+# opened in chrome://tracing or https://ui.perfetto.dev as it is written;
+# the closing bracket is optional in that format. Tracing is off unless
+# TRACE_PATH is set, and span() is then a no-op.
+import argparse
+import functools
+import json
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+TRACE_PATH = os.environ.get("TRACE_PATH", "")
+TRACE_MIN_MS = float(os.environ.get("TRACE_MIN_MS", "0"))
+
+_active = ContextVar("active_span", default=None)   # (_Trace, span id) of the innermost open span
+_write_lock = threading.Lock()
+
+
+def enabled():
+    return bool(TRACE_PATH)
+
+
+def new_correlation_id():
+    return uuid.uuid4().hex[:16]
+
+
+# Correlation ID of the trace open in this context, or None
+def correlation_id():
+    active = _active.get()
+    return active[0].correlation_id if active else None
+
+
+# (correlation ID, span ID) of the innermost open span, to hand to another
+# process; (None, None) outside a trace
+def current_context():
+    active = _active.get()
+    return (active[0].correlation_id, active[1]) if active else (None, None)
+
+
+def _span_id():
+    return uuid.uuid4().hex[:8]
+
+
+class _Trace:
+    def __init__(self, correlation_id):
+        self.correlation_id = correlation_id
+        self.events = []
+        self._lock = threading.Lock()
+
+    def add(self, event):
+        with self._lock:
+            self.events.append(event)
+
+
+def _now_us():
+    return time.time_ns() // 1000
+
+
+def _event(trace, name, ts, dur, span_id, parent_id, args):
+    return {
+        "name": name,
+        "cat": name.split(".", 1)[0],
+        "ph": "X",
+        "ts": ts,
+        "dur": dur,
+        "pid": os.getpid(),
+        "tid": threading.get_native_id(),
+        "args": dict(args, correlation_id=trace.correlation_id, span_id=span_id, parent_id=parent_id),
+    }
+
+
+def _write(events, path=None):
+    path = path or TRACE_PATH
+    lines = "".join(json.dumps(event, default=str) + ",\n" for event in events)
+    with _write_lock:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "a") as f:
+            if f.tell() == 0:
+                lines = "[\n" + lines
+            f.write(lines)
+
+
+# Time the block as a span named `name` ("stage.detail"). Outside any open
+# span, or with an explicit correlation_id, it is the root of a new trace
+# (written out when it ends); parent_id links such a root to a span of
+# another process. Yields a dict; keys added to it while the span is open
+# end up in the event's args (e.g. batch sizes known only afterwards).
+@contextmanager
+def span(name, correlation_id=None, parent_id=None, **args):
+    if not TRACE_PATH:
+        yield args
+        return
+    parent = _active.get()
+    root = parent is None or correlation_id is not None
+    trace = _Trace(correlation_id or new_correlation_id()) if root else parent[0]
+    span_id = _span_id()
+    token = _active.set((trace, span_id))
+    ts, start = _now_us(), time.perf_counter()
+    try:
+        yield args
+    except BaseException as e:
+        args["error"] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _active.reset(token)
+        dur = int((time.perf_counter() - start) * 1e6)
+        trace.add(_event(trace, name, ts, dur, span_id, parent_id if root else parent[1], args))
+        if root and dur >= TRACE_MIN_MS * 1000:
+            _write(trace.events)
+
+
+# Decorator form of span() for whole functions
+def traced(name):
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not TRACE_PATH:
+                return fn(*args, **kwargs)
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+# Record a child of the open span that was timed elsewhere (queue waits,
+# work done in another process): `seconds` long, ending `ago` seconds
+# before now. Ignored outside a trace.
+def add_span(name, seconds, ago=0.0, **args):
+    parent = _active.get()
+    if not TRACE_PATH or parent is None:
+        return
+    dur = int(seconds * 1e6)
+    ts = _now_us() - int(ago * 1e6) - dur
+    parent[0].add(_event(parent[0], name, ts, dur, _span_id(), parent[1], args))
+
+
+# Events of a trace file; tolerates the missing "]" and trailing comma of a
+# file that is still being written
+def load_events(path):
+    with open(path) as f:
+        text = f.read().strip()
+    if text.startswith("{"):
+        return json.loads(text)["traceEvents"]
+    text = text.rstrip(",")
+    if not text.endswith("]"):
+        text += "]"
+    return json.loads(text)
+
+
+# q-th percentile (nearest rank) of durations in microseconds, as ms
+def _ms(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, len(ordered) * q // 100)] / 1000
+
+
+def _print_table(header, rows):
+    widths = [max(len(str(v)) for v in col) for col in zip(header, *rows)]
+    for row in [header] + rows:
+        print("  ".join(str(v).rjust(w) for v, w in zip(row, widths)))
+
+
+# Per-stage latency percentiles, then the slowest correlation IDs with the
+# stages that took most of their time
+def summary(args):
+    events = [e for e in load_events(args.path) if e.get("ph") == "X"]
+    if not events:
+        raise SystemExit(f"No spans in {args.path}")
+    by_name = defaultdict(list)
+    by_request = defaultdict(list)
+    for event in events:
+        by_name[event["name"]].append(event["dur"])
+        by_request[event["args"].get("correlation_id")].append(event)
+
+    rows = [[name, len(durs), f"{_ms(durs, 50):.1f}", f"{_ms(durs, 95):.1f}", f"{max(durs) / 1000:.1f}"]
+            for name, durs in sorted(by_name.items(), key=lambda item: -_ms(item[1], 95))]
+    print(f"{len(events)} spans from {len(by_request)} correlation IDs in {args.path}")
+    _print_table(["stage", "n", "p50 ms", "p95 ms", "max ms"], rows)
+
+    def _total(spans):
+        return sum(e["dur"] for e in spans if e["args"].get("parent_id") is None)
+
+    print(f"\nSlowest {args.top}:")
+    for cid, spans in sorted(by_request.items(), key=lambda item: -_total(item[1]))[:args.top]:
+        roots = ", ".join(sorted({e["name"] for e in spans if e["args"].get("parent_id") is None}))
+        stages = defaultdict(int)
+        for e in spans:
+            if e["args"].get("parent_id") is not None:
+                stages[e["name"]] += e["dur"]
+        top = ", ".join(f"{name} {dur / 1000:.0f}" for name, dur in
+                        sorted(stages.items(), key=lambda item: -item[1])[:4])
+        print(f"  {cid}  {_total(spans) / 1000:.0f} ms  [{roots}]  {top}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect request traces written with TRACE_PATH")
+    sub = parser.add_subparsers(dest="command", required=True)
+    summary_parser = sub.add_parser("summary", help="stage latency percentiles and the slowest requests")
+    summary_parser.add_argument("path", nargs="?", default=TRACE_PATH or "traces.json")
+    summary_parser.add_argument("--top", type=int, default=10, help="slowest correlation IDs to list")
+    summary_parser.set_defaults(func=summary)
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()